@@ -0,0 +1,265 @@
+"""Общие подключения к PostgreSQL, Redis и MongoDB для скриптов в test/.
+
+Параметры берутся из переменных окружения, по умолчанию - прежние
+значения из скриптов. Клиенты создаются лениво, по одному пулу на
+процесс, и переиспользуются всеми вызовами, поэтому установка
+соединений и аутентификация не попадают в замеры. Время получения
+соединения из пула собирается в acquire_metrics().
+"""
+import atexit
+import os
+import statistics
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+POSTGRES_CONFIG = {
+    "host": os.environ.get("PGHOST", "192.168.50.24"),
+    "port": int(os.environ.get("PGPORT", "5432")),
+    "database": os.environ.get("PGDATABASE", "demo"),
+    "user": os.environ.get("PGUSER", "postgres"),
+    "password": os.environ.get("PGPASSWORD", "postgres")
+}
+
+REDIS_CONFIG = {
+    "host": os.environ.get("REDIS_HOST", "192.168.50.24"),
+    "port": int(os.environ.get("REDIS_PORT", "6379")),
+    "db": int(os.environ.get("REDIS_DB", "0"))
+}
+
+MONGO_CONFIG = {
+    "host": os.environ.get("MONGO_HOST", "192.168.50.24"),
+    "port": int(os.environ.get("MONGO_PORT", "27017")),
+    "username": os.environ.get("MONGO_USER", "root"),
+    "password": os.environ.get("MONGO_PASSWORD", "root"),
+    "authSource": os.environ.get("MONGO_AUTH_SOURCE", "admin"),
+    "authMechanism": "SCRAM-SHA-256"
+}
+
+# Размеры пулов и проверки соединений
+POOL_SETTINGS = {
+    "pg_min": int(os.environ.get("PG_POOL_MIN", "1")),
+    "pg_max": int(os.environ.get("PG_POOL_MAX", "10")),
+    "redis_max": int(os.environ.get("REDIS_POOL_MAX", "50")),
+    "mongo_min": int(os.environ.get("MONGO_POOL_MIN", "0")),
+    "mongo_max": int(os.environ.get("MONGO_POOL_MAX", "100")),
+    "pool_timeout": float(os.environ.get("POOL_TIMEOUT", "10")),
+    "health_check_interval": int(os.environ.get("HEALTH_CHECK_INTERVAL", "30"))
+}
+
+_lock = threading.RLock()
+_state = {"pid": None}
+# Клиенты, унаследованные от родителя через fork. Ссылки держим до конца
+# процесса: при удалении объекта psycopg2 закрыл бы общий с родителем сокет.
+_inherited = []
+_acquire_times = defaultdict(list)
+
+def configure_pools(**settings):
+    """Изменение размеров пулов; действует на пулы, созданные после вызова"""
+    unknown = set(settings) - set(POOL_SETTINGS)
+    if unknown:
+        raise ValueError(f"Неизвестные параметры пулов: {', '.join(sorted(unknown))}")
+    POOL_SETTINGS.update(settings)
+
+def _process_state():
+    """Состояние пулов текущего процесса; после fork пулы родителя не используются"""
+    if _state["pid"] != os.getpid():
+        if _state["pid"] is not None:
+            _inherited.append(dict(_state))
+        _state.clear()
+        _state["pid"] = os.getpid()
+        _state["pg_last_used"] = {}
+    return _state
+
+def _record(backend, seconds):
+    with _lock:
+        _acquire_times[backend].append(seconds)
+
+def acquire_metrics():
+    """Сводка по времени получения соединений из пулов, мс"""
+    with _lock:
+        samples = {backend: list(times) for backend, times in _acquire_times.items()}
+    return {
+        backend: {
+            "count": len(times),
+            "p50_ms": statistics.median(times) * 1000,
+            "max_ms": max(times) * 1000,
+            "total_ms": sum(times) * 1000
+        }
+        for backend, times in samples.items() if times
+    }
+
+def print_acquire_metrics():
+    for backend, metrics in acquire_metrics().items():
+        print(f"Получение соединения {backend}: {metrics['count']} раз, "
+              f"p50 {metrics['p50_ms']:.3f} мс, max {metrics['max_ms']:.3f} мс")
+
+# --- PostgreSQL ---
+
+def get_pg_pool():
+    """Пул соединений psycopg2 текущего процесса"""
+    from psycopg2.pool import ThreadedConnectionPool
+
+    with _lock:
+        state = _process_state()
+        if "pg_pool" not in state:
+            state["pg_pool"] = ThreadedConnectionPool(
+                POOL_SETTINGS["pg_min"], POOL_SETTINGS["pg_max"], **POSTGRES_CONFIG
+            )
+        return state["pg_pool"]
+
+def _pg_alive(conn):
+    """Проверка соединения, простоявшего в пуле дольше health_check_interval"""
+    if conn.closed:
+        return False
+    last_used = _process_state()["pg_last_used"].get(id(conn))
+    if last_used and time.monotonic() - last_used < POOL_SETTINGS["health_check_interval"]:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except Exception:
+        return False
+
+def acquire_pg():
+    """Соединение psycopg2 из пула; при исчерпании пула ждёт до pool_timeout"""
+    from psycopg2.pool import PoolError
+
+    pool = get_pg_pool()
+    start_time = time.perf_counter()
+    deadline = time.monotonic() + POOL_SETTINGS["pool_timeout"]
+    while True:
+        try:
+            conn = pool.getconn()
+        except PoolError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+            continue
+        if _pg_alive(conn):
+            break
+        pool.putconn(conn, close=True)
+    _record("postgres", time.perf_counter() - start_time)
+    return conn
+
+def release_pg(conn, close=False):
+    """Возврат соединения в пул (незавершённая транзакция откатывается пулом)"""
+    _process_state()["pg_last_used"][id(conn)] = time.monotonic()
+    get_pg_pool().putconn(conn, close=close or conn.closed)
+
+@contextmanager
+def pg_connection():
+    conn = acquire_pg()
+    try:
+        yield conn
+    finally:
+        release_pg(conn)
+
+# --- Redis ---
+
+def get_redis(decode_responses=False):
+    """Клиент Redis поверх общего блокирующего пула процесса"""
+    import redis
+
+    with _lock:
+        state = _process_state()
+        name = f"redis_{decode_responses}"
+        if name not in state:
+            class TimedConnectionPool(redis.BlockingConnectionPool):
+                def get_connection(self, *args, **kwargs):
+                    start_time = time.perf_counter()
+                    try:
+                        return super().get_connection(*args, **kwargs)
+                    finally:
+                        _record("redis", time.perf_counter() - start_time)
+
+            pool = TimedConnectionPool(
+                max_connections=POOL_SETTINGS["redis_max"],
+                timeout=POOL_SETTINGS["pool_timeout"],
+                health_check_interval=POOL_SETTINGS["health_check_interval"],
+                decode_responses=decode_responses,
+                **REDIS_CONFIG
+            )
+            state[name] = redis.Redis(connection_pool=pool)
+        return state[name]
+
+# --- MongoDB ---
+
+def _mongo_listener():
+    from pymongo import monitoring
+
+    class AcquireListener(monitoring.ConnectionPoolListener):
+        """Время от запроса соединения до его выдачи пулом MongoClient"""
+        started = threading.local()
+
+        def connection_check_out_started(self, event):
+            self.started.value = time.perf_counter()
+
+        def connection_checked_out(self, event):
+            start_time = getattr(self.started, "value", None)
+            if start_time is not None:
+                _record("mongo", time.perf_counter() - start_time)
+                self.started.value = None
+
+        def connection_check_out_failed(self, event):
+            self.started.value = None
+
+        def pool_created(self, event):
+            pass
+
+        def pool_ready(self, event):
+            pass
+
+        def pool_cleared(self, event):
+            pass
+
+        def pool_closed(self, event):
+            pass
+
+        def connection_created(self, event):
+            pass
+
+        def connection_ready(self, event):
+            pass
+
+        def connection_closed(self, event):
+            pass
+
+        def connection_checked_in(self, event):
+            pass
+
+    return AcquireListener()
+
+def get_mongo():
+    """Общий MongoClient процесса: одна аутентификация на соединение пула"""
+    from pymongo import MongoClient
+
+    with _lock:
+        state = _process_state()
+        if "mongo" not in state:
+            state["mongo"] = MongoClient(
+                **MONGO_CONFIG,
+                minPoolSize=POOL_SETTINGS["mongo_min"],
+                maxPoolSize=POOL_SETTINGS["mongo_max"],
+                waitQueueTimeoutMS=int(POOL_SETTINGS["pool_timeout"] * 1000),
+                heartbeatFrequencyMS=POOL_SETTINGS["health_check_interval"] * 1000,
+                event_listeners=[_mongo_listener()]
+            )
+        return state["mongo"]
+
+def close_all():
+    """Закрытие всех пулов текущего процесса"""
+    with _lock:
+        state = _process_state()
+        if "pg_pool" in state:
+            state.pop("pg_pool").closeall()
+        for name in ("redis_True", "redis_False"):
+            if name in state:
+                state.pop(name).connection_pool.disconnect()
+        if "mongo" in state:
+            state.pop("mongo").close()
+
+atexit.register(close_all)
@@ -1,83 +1,558 @@
-import psycopg2
-import redis
-from datetime import datetime
-
-# Конфигурация подключений
-POSTGRES_CONFIG = {
-    "host": "192.168.50.24",
-    "database": "demo",
-    "user": "postgres",
-    "password": "postgres"
-}
-
-REDIS_CONFIG = {
-    "host": "192.168.50.24",
-    "port": 6379,
-    "db": 0,
-    "decode_responses": False
-}
-
-def main():
-    # Подключение к БД
-    pg_conn = psycopg2.connect(**POSTGRES_CONFIG)
-    redis_conn = redis.Redis(**REDIS_CONFIG)
-    
-    sorted_set_key = "ticket_flights:amount"
+import argparse
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from connections import acquire_pg, get_redis, release_pg
+
+SORTED_SET_KEY = "ticket_flights:amount"
+# Случайная выборка пишется в отдельный ключ, чтобы не затирать полный индекс
+SAMPLE_KEY = "ticket_flights:amount:sample"
+ITERSIZE = 10000
+BATCH_SIZE = 5000
+# Процент страниц для TABLESAMPLE SYSTEM подбирается по pg_class: ожидаемое
+# число строк - SAMPLE_MARGIN x limit, но не меньше SAMPLE_MIN_PAGES страниц,
+# иначе выборка из целых страниц часто оказывается пустой
+SAMPLE_MARGIN = 10
+SAMPLE_MIN_PAGES = 20
+
+# Детали билета (пассажир, рейс, вылет) хранятся вне ZSET, в хэшах по
+# DETAILS_BUCKET билетов: ~32 билета x 1-4 перелёта укладываются в лимиты
+# hash-max-listpack-entries (128) и hash-max-listpack-value (64 байта),
+# и Redis хранит такой хэш компактным listpack.
+DETAILS_PREFIX = "ticket_flights:details"
+DETAILS_BUCKET = 32
+COMPARE_ROWS = 100000
+# Ключ pg_advisory_lock, общий для build и sync: sync во время build применил
+# бы к старому ZSET изменения, которые затем затёр бы RENAME снимка
+INDEX_LOCK_KEY = 0x7466616d  # 'tfam'
+
+TICKET_FLIGHTS_SELECT = """
+    SELECT tf.ticket_no, tf.flight_id, tf.amount,
+           t.passenger_name, f.flight_no, f.scheduled_departure
+    FROM ticket_flights tf
+    JOIN tickets t ON tf.ticket_no = t.ticket_no
+    JOIN flights f ON tf.flight_id = f.flight_id
+"""
+
+# Журнал изменений ticket_flights для инкрементального обновления индекса
+CHANGE_TRACKING_DDL = """
+    CREATE TABLE IF NOT EXISTS ticket_flights_changes (
+        change_id bigserial PRIMARY KEY,
+        ticket_no char(13) NOT NULL,
+        flight_id integer NOT NULL,
+        changed_at timestamptz NOT NULL DEFAULT now()
+    );
+    -- Старая цена не нужна: элемент ZSET - ключ перелёта, а не цена
+    ALTER TABLE ticket_flights_changes DROP COLUMN IF EXISTS old_amount;
+
+    CREATE OR REPLACE FUNCTION log_ticket_flights_change() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO ticket_flights_changes (ticket_no, flight_id)
+            VALUES (NEW.ticket_no, NEW.flight_id);
+        ELSE
+            INSERT INTO ticket_flights_changes (ticket_no, flight_id)
+            VALUES (OLD.ticket_no, OLD.flight_id);
+            IF TG_OP = 'UPDATE' AND (NEW.ticket_no, NEW.flight_id)
+                    IS DISTINCT FROM (OLD.ticket_no, OLD.flight_id) THEN
+                INSERT INTO ticket_flights_changes (ticket_no, flight_id)
+                VALUES (NEW.ticket_no, NEW.flight_id);
+            END IF;
+        END IF;
+        RETURN NULL;
+    END $$;
+
+    DROP TRIGGER IF EXISTS ticket_flights_changes_log ON ticket_flights;
+    CREATE TRIGGER ticket_flights_changes_log
+        AFTER INSERT OR UPDATE OR DELETE ON ticket_flights
+        FOR EACH ROW EXECUTE FUNCTION log_ticket_flights_change();
+"""
+
+def make_member(ticket_no, flight_id):
+    """Элемент ZSET - только ключ перелёта, около 20 байт"""
+    return f"{ticket_no}:{flight_id}"
+
+def parse_member(member):
+    ticket_no, flight_id = member.split(':')
+    return ticket_no, int(flight_id)
+
+def details_key(member, prefix=DETAILS_PREFIX):
+    """Хэш с деталями: билеты группируются по номеру, поле - сам элемент ZSET"""
+    return f"{prefix}:{int(member.split(':')[0]) // DETAILS_BUCKET}"
+
+def pack_details(passenger, flight_no, dep_time):
+    """Детали одной строкой: время вылета - секунды эпохи вместо ISO-строки"""
+    return f"{passenger}|{flight_no}|{int(dep_time.timestamp())}"
+
+def unpack_details(value):
+    passenger, flight_no, departure = value.split('|')
+    return {
+        "passenger": passenger,
+        "flight_no": flight_no,
+        "departure": datetime.fromtimestamp(int(departure), timezone.utc)
+    }
+
+def add_rows(pipe, key, rows, details_prefix=DETAILS_PREFIX):
+    """ZADD пачки строк запроса TICKET_FLIGHTS_SELECT и HSET их деталей"""
+    if not rows:
+        return
+    scores = {}
+    details = {}
+    for ticket_no, flight_id, amount, passenger, flight_no, dep_time in rows:
+        member = make_member(ticket_no, flight_id)
+        scores[member] = float(amount)
+        details.setdefault(details_key(member, details_prefix), {})[member] = (
+            pack_details(passenger, flight_no, dep_time)
+        )
+    pipe.zadd(key, scores)
+    for bucket_key, mapping in details.items():
+        pipe.hset(bucket_key, mapping=mapping)
+
+def remove_members(pipe, members, key=SORTED_SET_KEY, details_prefix=DETAILS_PREFIX):
+    """ZREM удалённых перелётов и HDEL их деталей"""
+    if not members:
+        return
+    pipe.zrem(key, *members)
+    buckets = {}
+    for member in members:
+        buckets.setdefault(details_key(member, details_prefix), []).append(member)
+    for bucket_key, fields in buckets.items():
+        pipe.hdel(bucket_key, *fields)
+
+def fetch_details(redis_conn, members, details_prefix=DETAILS_PREFIX):
+    """Детали только для найденных элементов: HMGET по хэшу в одном конвейере"""
+    buckets = {}
+    for member in members:
+        buckets.setdefault(details_key(member, details_prefix), []).append(member)
+    pipe = redis_conn.pipeline(transaction=False)
+    for bucket_key, fields in buckets.items():
+        pipe.hmget(bucket_key, fields)
+    details = {}
+    for fields, values in zip(buckets.values(), pipe.execute()):
+        for member, value in zip(fields, values):
+            details[member] = unpack_details(value) if value else None
+    return details
+
+def install_change_tracking(pg_conn):
+    """Создание журнала изменений и триггера на ticket_flights"""
+    with pg_conn.cursor() as cursor:
+        cursor.execute(CHANGE_TRACKING_DDL)
+    pg_conn.commit()
+    print("Триггер журнала изменений ticket_flights установлен")
+
+def change_tracking_installed(pg_conn):
+    with pg_conn.cursor() as cursor:
+        cursor.execute("SELECT to_regclass('ticket_flights_changes') IS NOT NULL")
+        installed = cursor.fetchone()[0]
+    pg_conn.rollback()
+    return installed
+
+def prune_details(redis_conn, keys=(SORTED_SET_KEY, SAMPLE_KEY), details_prefix=DETAILS_PREFIX,
+                  batch_size=BATCH_SIZE):
+    """HDEL деталей перелётов, которых нет ни в одном ZSET из keys.
+
+    Так удаляются детали строк, исчезнувших между перестройками без
+    журнала изменений. Хэши обходятся SCAN, наличие полей проверяется
+    ZMSCORE. apply_changes пишет ZADD раньше HSET, поэтому детали новых
+    перелётов не удаляются; перелёт, удалённый и тут же вставленный заново
+    во время очистки, может остаться без деталей до следующей перестройки -
+    fetch_details вернёт для него None.
+    """
+    pruned = 0
+    bucket_keys = []
+
+    def flush():
+        nonlocal pruned
+        pipe = redis_conn.pipeline(transaction=False)
+        for bucket_key in bucket_keys:
+            pipe.hkeys(bucket_key)
+        buckets = [(bucket_key, members)
+                   for bucket_key, members in zip(bucket_keys, pipe.execute()) if members]
+        pipe = redis_conn.pipeline(transaction=False)
+        for _, members in buckets:
+            for key in keys:
+                pipe.zmscore(key, members)
+        replies = pipe.execute()
+        pipe = redis_conn.pipeline(transaction=False)
+        for i, (bucket_key, members) in enumerate(buckets):
+            key_scores = replies[i * len(keys):(i + 1) * len(keys)]
+            orphans = [member for member, *scores in zip(members, *key_scores)
+                       if all(score is None for score in scores)]
+            if orphans:
+                pipe.hdel(bucket_key, *orphans)
+                pruned += len(orphans)
+        pipe.execute()
+        bucket_keys.clear()
+
+    for bucket_key in redis_conn.scan_iter(match=f"{details_prefix}:*", count=1000):
+        bucket_keys.append(bucket_key)
+        if len(bucket_keys) * DETAILS_BUCKET >= batch_size:
+            flush()
+    if bucket_keys:
+        flush()
+    return pruned
+
+@contextmanager
+def index_lock(pg_conn):
+    """Сессионная advisory-блокировка индекса на время build или sync.
+
+    Берётся в отдельной транзакции до снимка build: снимок REPEATABLE READ
+    получается уже после того, как закончился текущий sync.
+    """
+    with pg_conn.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_lock(%s)", (INDEX_LOCK_KEY,))
+    pg_conn.commit()
+    try:
+        yield
+    finally:
+        pg_conn.rollback()
+        with pg_conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (INDEX_LOCK_KEY,))
+        pg_conn.commit()
+
+def build_full_index(pg_conn, redis_conn, itersize=ITERSIZE, batch_size=BATCH_SIZE):
+    """Полная загрузка ticket_flights.amount в ZSET.
+
+    Строки читаются серверным курсором без сортировки и пишутся пачками
+    ZADD во временный ключ, который затем атомарно заменяет рабочий через
+    RENAME - читатели не видят ни пустого, ни наполовину заполненного индекса.
+    Снимок берётся в REPEATABLE READ, и в той же транзакции очищается журнал
+    изменений: в нём остаются только изменения, не попавшие в снимок.
+    Хэши деталей пишутся сразу в рабочие ключи - запись по ключу перелёта
+    идемпотентна, а после замены ZSET prune_details удаляет детали
+    перелётов, которых в новом индексе нет.
+    """
+    with index_lock(pg_conn):
+        tmp_key = f"{SORTED_SET_KEY}:building"
+        redis_conn.delete(tmp_key)
+        tracking = change_tracking_installed(pg_conn)
+
+        loaded = 0
+        start_time = datetime.now()
+        try:
+            with pg_conn.cursor() as cursor:
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                if tracking:
+                    cursor.execute("DELETE FROM ticket_flights_changes")
+
+            with pg_conn.cursor(name="ticket_flights_amount") as cursor:
+                cursor.itersize = itersize
+                cursor.execute(TICKET_FLIGHTS_SELECT)
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    pipe = redis_conn.pipeline(transaction=False)
+                    add_rows(pipe, tmp_key, rows)
+                    pipe.execute()
+                    loaded += len(rows)
+
+            if loaded:
+                redis_conn.rename(tmp_key, SORTED_SET_KEY)
+            else:
+                redis_conn.delete(SORTED_SET_KEY)
+            pg_conn.commit()
+        except Exception:
+            pg_conn.rollback()
+            redis_conn.delete(tmp_key)
+            raise
+
+        pruned = prune_details(redis_conn, batch_size=batch_size)
+        elapsed = (datetime.now() - start_time).total_seconds()
+        print(f"Загружено {loaded} цен в {SORTED_SET_KEY} за {elapsed:.1f} сек, "
+              f"удалено устаревших деталей: {pruned}")
+        if not tracking:
+            print("Журнал изменений не установлен: для инкрементального обновления "
+                  "запустите с --install-tracking")
+        return loaded
+
+def apply_changes(pg_conn, redis_conn, batch_size=BATCH_SIZE):
+    """Применение журнала изменений к ZSET без перестройки индекса.
+
+    Пачка забирается DELETE ... RETURNING. Обработчики и build_full_index
+    сериализуются index_lock: параллельные обработчики могли бы записать
+    один перелёт в Redis в обратном порядке. Элемент ZSET - ключ перелёта,
+    поэтому изменённые строки просто перезаписываются ZADD/HSET, а
+    исчезнувшие удаляются ZREM/HDEL. Транзакция фиксируется только
+    после записи в Redis: при ошибке изменения вернутся в журнал.
+    """
+    with index_lock(pg_conn):
+        totals = {"changes": 0, "removed": 0, "added": 0}
+        while True:
+            try:
+                with pg_conn.cursor() as cursor:
+                    cursor.execute("""
+                        DELETE FROM ticket_flights_changes
+                        WHERE change_id IN (
+                            SELECT change_id FROM ticket_flights_changes
+                            ORDER BY change_id
+                            LIMIT %s
+                            FOR UPDATE SKIP LOCKED
+                        )
+                        RETURNING ticket_no, flight_id
+                    """, (batch_size,))
+                    changes = cursor.fetchall()
+                    if not changes:
+                        pg_conn.commit()
+                        break
+
+                    keys = sorted(set(changes))
+
+                    cursor.execute(
+                        TICKET_FLIGHTS_SELECT + " WHERE (tf.ticket_no, tf.flight_id) IN %s",
+                        (tuple(keys),)
+                    )
+                    rows = cursor.fetchall()
+
+                present = {make_member(row[0], row[1]) for row in rows}
+                removed = [make_member(*key) for key in keys if make_member(*key) not in present]
+                pipe = redis_conn.pipeline(transaction=False)
+                remove_members(pipe, removed)
+                add_rows(pipe, SORTED_SET_KEY, rows)
+                pipe.execute()
+                pg_conn.commit()
+            except Exception:
+                pg_conn.rollback()
+                raise
+
+            totals["changes"] += len(changes)
+            totals["removed"] += len(removed)
+            totals["added"] += len(rows)
+
+        print(f"Изменений применено: {totals['changes']}, удалено элементов: "
+              f"{totals['removed']}, добавлено: {totals['added']}")
+        return totals
+
+def sample_percent(cursor, limit, margin=SAMPLE_MARGIN, min_pages=SAMPLE_MIN_PAGES):
+    """Процент страниц ticket_flights, дающий с запасом не меньше limit строк"""
+    cursor.execute("""
+        SELECT reltuples, relpages FROM pg_class WHERE oid = 'ticket_flights'::regclass
+    """)
+    reltuples, relpages = cursor.fetchone()
+    if reltuples <= 0 or relpages <= 0:
+        # Статистики нет (таблица не анализировалась) - читаем все страницы
+        return 100.0
+    percent = max(limit * margin / reltuples, min_pages / relpages) * 100
+    return min(percent, 100.0)
+
+def sample_rows(pg_conn, limit=10, percent=None):
+    """Случайная выборка через TABLESAMPLE SYSTEM вместо сортировки ORDER BY RANDOM().
+
+    percent=None - процент страниц рассчитывается по статистике таблицы.
+    """
+    with pg_conn.cursor() as cursor:
+        if percent is None:
+            percent = sample_percent(cursor, limit)
+        cursor.execute("""
+            SELECT tf.ticket_no, tf.flight_id, tf.amount,
+                   t.passenger_name, f.flight_no, f.scheduled_departure
+            FROM ticket_flights tf TABLESAMPLE SYSTEM (%s)
+            JOIN tickets t ON tf.ticket_no = t.ticket_no
+            JOIN flights f ON tf.flight_id = f.flight_id
+            LIMIT %s
+        """, (percent, limit))
+        rows = cursor.fetchall()
+    pg_conn.rollback()
+    return rows
+
+# --- Запросы к индексу ---
+
+def top_n(redis_conn, n=3, key=SORTED_SET_KEY):
+    """N самых дорогих билетов"""
+    return redis_conn.zrange(key, 0, n - 1, desc=True, withscores=True)
+
+def bottom_n(redis_conn, n=3, key=SORTED_SET_KEY):
+    """N самых дешёвых билетов"""
+    return redis_conn.zrange(key, 0, n - 1, withscores=True)
+
+def count_in_range(redis_conn, min_amount, max_amount, key=SORTED_SET_KEY):
+    """Число билетов с ценой в диапазоне [min_amount, max_amount]"""
+    return redis_conn.zcount(key, min_amount, max_amount)
+
+def price_percentile(redis_conn, p, key=SORTED_SET_KEY):
+    """Цена на p-м перцентиле (ближайший ранг) - O(log N) через ранг в ZSET"""
+    card = redis_conn.zcard(key)
+    if not card:
+        return None
+    rank = round(p / 100 * (card - 1))
+    entry = redis_conn.zrange(key, rank, rank, withscores=True)
+    return entry[0][1] if entry else None
+
+def price_rank(redis_conn, member, key=SORTED_SET_KEY):
+    """Доля билетов дешевле данного (ZRANK / ZCARD)"""
+    rank = redis_conn.zrank(key, member)
+    if rank is None:
+        return None
+    return rank / redis_conn.zcard(key)
+
+def memory_usage(redis_conn, keys):
+    """Суммарный MEMORY USAGE ключей (SAMPLES 0 - точный подсчёт всех элементов)"""
+    pipe = redis_conn.pipeline(transaction=False)
+    for key in keys:
+        pipe.execute_command("MEMORY USAGE", key, "SAMPLES", "0")
+    return sum(size or 0 for size in pipe.execute())
+
+def compare_layouts(pg_conn, redis_conn, rows_limit=COMPARE_ROWS, batch_size=BATCH_SIZE):
+    """Сравнение памяти: прежние длинные элементы и компактный ZSET + хэши деталей.
+
+    Одни и те же строки пишутся во временные ключи в обоих форматах,
+    результат пересчитывается на полный объём ticket_flights.
+    """
+    wide_key = f"{SORTED_SET_KEY}:cmp:wide"
+    compact_key = f"{SORTED_SET_KEY}:cmp:compact"
+    details_prefix = f"{SORTED_SET_KEY}:cmp:details"
+    details_keys = set()
 
     try:
+        with pg_conn.cursor(name="ticket_flights_compare") as cursor:
+            cursor.itersize = batch_size
+            cursor.execute(TICKET_FLIGHTS_SELECT + " LIMIT %s", (rows_limit,))
+            loaded = 0
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                pipe = redis_conn.pipeline(transaction=False)
+                pipe.zadd(wide_key, {
+                    f"{ticket_no}:{flight_id}:{passenger}:{flight_no}:{dep_time}": float(amount)
+                    for ticket_no, flight_id, amount, passenger, flight_no, dep_time in rows
+                })
+                add_rows(pipe, compact_key, rows, details_prefix)
+                pipe.execute()
+                details_keys.update(details_key(make_member(*row[:2]), details_prefix)
+                                    for row in rows)
+                loaded += len(rows)
         with pg_conn.cursor() as cursor:
-            # Выбираем 10 случайных записей с ценами билетов
-            cursor.execute("""
-                SELECT tf.ticket_no, tf.flight_id, tf.amount, 
-                       t.passenger_name, f.flight_no, f.scheduled_departure
-                FROM ticket_flights tf
-                JOIN tickets t ON tf.ticket_no = t.ticket_no
-                JOIN flights f ON tf.flight_id = f.flight_id
-                ORDER BY RANDOM()
-                LIMIT 10
-            """)
-            
-            results = cursor.fetchall()
-            
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = 'ticket_flights'")
+            total_rows = max(cursor.fetchone()[0], loaded)
+
+        if not loaded:
+            print("Нет данных для сравнения")
+            return None
+
+        wide = memory_usage(redis_conn, [wide_key])
+        compact_zset = memory_usage(redis_conn, [compact_key])
+        details = memory_usage(redis_conn, details_keys)
+        encodings = {
+            redis_conn.object("encoding", key) for key in list(details_keys)[:100]
+        }
+    finally:
+        pg_conn.rollback()
+        for key in [wide_key, compact_key, *details_keys]:
+            redis_conn.unlink(key)
+
+    scale = total_rows / loaded
+    report = {
+        "rows": loaded,
+        "wide_bytes": wide,
+        "compact_zset_bytes": compact_zset,
+        "details_bytes": details,
+        "wide_per_row": wide / loaded,
+        "compact_per_row": (compact_zset + details) / loaded,
+        "details_encodings": sorted(encodings)
+    }
+    print(f"\n=== Память: {loaded} строк, оценка для {total_rows} ===")
+    print(f"Длинные элементы ZSET: {wide / loaded:.1f} байт/строку, "
+          f"~{wide * scale / 2 ** 20:.0f} МБ")
+    print(f"Компактный ZSET: {compact_zset / loaded:.1f} байт/строку, "
+          f"~{compact_zset * scale / 2 ** 20:.0f} МБ")
+    print(f"Хэши деталей ({len(details_keys)} шт., {', '.join(report['details_encodings'])}): "
+          f"{details / loaded:.1f} байт/строку, ~{details * scale / 2 ** 20:.0f} МБ")
+    print(f"Экономия: {1 - (compact_zset + details) / wide:.0%}")
+    return report
+
+def print_entries(redis_conn, title, entries):
+    print(title)
+    details = fetch_details(redis_conn, [member for member, _ in entries])
+    for i, (member, score) in enumerate(entries, 1):
+        info = details[member]
+        if info is None:
+            print(f"{i}. {member} - {score:.2f} руб. | детали не найдены")
+            continue
+        print(f"{i}. {info['passenger']} (Рейс {info['flight_no']}) - {score:.2f} руб. "
+              f"| Вылет: {info['departure']}")
+
+def print_report(redis_conn, n=3, ranges=(), percentiles=(50, 90, 99), key=SORTED_SET_KEY):
+    print(f"Элементов в {key}: {redis_conn.zcard(key)}")
+    print_entries(redis_conn, f"\nСамые дешевые билеты ({n}):", bottom_n(redis_conn, n, key))
+    print_entries(redis_conn, f"\nСамые дорогие билеты ({n}):", top_n(redis_conn, n, key))
+    for min_amount, max_amount in ranges:
+        print(f"\nБилетов от {min_amount} до {max_amount} руб.: "
+              f"{count_in_range(redis_conn, min_amount, max_amount, key)}")
+    if percentiles:
+        print()
+    for p in percentiles:
+        amount = price_percentile(redis_conn, p, key)
+        if amount is not None:
+            print(f"p{p:g}: {amount:.2f} руб.")
+
+def main(mode="sample", limit=10, percent=None, itersize=ITERSIZE,
+         batch_size=BATCH_SIZE, install_tracking=False, top=3, ranges=(),
+         percentiles=(50, 90, 99), compare_rows=COMPARE_ROWS):
+    # Подключение к БД
+    pg_conn = acquire_pg()
+    redis_conn = get_redis(decode_responses=True)
+
+    try:
+        if install_tracking:
+            install_change_tracking(pg_conn)
+
+        if mode == "sample":
+            results = sample_rows(pg_conn, limit, percent)
             if not results:
                 print("Нет данных для обработки")
                 return
+            # Выборка заменяет предыдущую целиком
+            pipe = redis_conn.pipeline()
+            pipe.delete(SAMPLE_KEY)
+            add_rows(pipe, SAMPLE_KEY, results)
+            pipe.execute()
+            print_report(redis_conn, top, ranges, (), key=SAMPLE_KEY)
+            return
 
-            # Очищаем предыдущие данные
-            redis_conn.delete(sorted_set_key)
-
-            # Добавляем в Redis sorted set
-            for row in results:
-                ticket_no, flight_id, amount, passenger, flight_no, dep_time = row
-                member = f"{ticket_no}:{flight_id}:{passenger}:{flight_no}:{dep_time}"
-                redis_conn.zadd(sorted_set_key, {member: float(amount)})
-
-            # Получаем экстремальные значения
-            min_entries = redis_conn.zrange(
-                sorted_set_key, 0, 2, withscores=True, desc=False
-            )
-            
-            max_entries = redis_conn.zrevrange(
-                sorted_set_key, 0, 2, withscores=True
-            )
-
-            print("Три самых дешевых билета:")
-            for i, (member, score) in enumerate(min_entries, 1):
-                parts = member.decode().split(':')
-                print(f"{i}. {parts[2]} (Рейс {parts[3]}) - {score:.2f} руб. "
-                      f"| Вылет: {parts[4]}")
-
-            print("\nТри самых дорогих билета:")
-            for i, (member, score) in enumerate(max_entries, 1):
-                parts = member.decode().split(':')
-                print(f"{i}. {parts[2]} (Рейс {parts[3]}) - {score:.2f} руб. "
-                      f"| Вылет: {parts[4]}")
+        if mode == "memory":
+            compare_layouts(pg_conn, redis_conn, compare_rows, batch_size)
+            return
+
+        if mode == "build":
+            build_full_index(pg_conn, redis_conn, itersize, batch_size)
+        elif mode == "sync":
+            apply_changes(pg_conn, redis_conn, batch_size)
+        print_report(redis_conn, top, ranges, percentiles)
 
     except Exception as e:
         print(f"Ошибка: {str(e)}")
     finally:
-        pg_conn.close()
-        redis_conn.close()
+        release_pg(pg_conn)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Индекс цен билетов в Redis sorted set")
+    parser.add_argument("--mode", choices=("sample", "build", "sync", "query", "memory"),
+                        default="sample",
+                        help="sample - случайная выборка, build - полная загрузка, "
+                             "sync - применение журнала изменений, query - только запросы, "
+                             "memory - сравнение расхода памяти форматов")
+    parser.add_argument("--limit", type=int, default=10, help="строк в случайной выборке")
+    parser.add_argument("--sample-percent", type=float,
+                        help="процент страниц ticket_flights для TABLESAMPLE SYSTEM "
+                             "(по умолчанию - по статистике таблицы)")
+    parser.add_argument("--itersize", type=int, default=ITERSIZE,
+                        help="строк за одну выборку серверного курсора")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help="элементов в одном ZADD / изменений за одну транзакцию")
+    parser.add_argument("--install-tracking", action="store_true",
+                        help="создать журнал изменений и триггер на ticket_flights")
+    parser.add_argument("--compare-rows", type=int, default=COMPARE_ROWS,
+                        help="строк для сравнения расхода памяти")
+    parser.add_argument("--top", type=int, default=3, help="сколько билетов показать")
+    parser.add_argument("--range", nargs=2, type=float, action="append", default=[],
+                        metavar=("MIN", "MAX"), help="посчитать билеты в диапазоне цен")
+    parser.add_argument("--percentiles", type=float, nargs="*", default=[50, 90, 99],
+                        help="перцентили цены")
+    args = parser.parse_args()
+
+    main(mode=args.mode, limit=args.limit, percent=args.sample_percent,
+         itersize=args.itersize, batch_size=args.batch_size,
+         install_tracking=args.install_tracking, top=args.top,
+         ranges=[tuple(r) for r in args.range], percentiles=args.percentiles,
+         compare_rows=args.compare_rows)
@@ -1,139 +1,683 @@
+import argparse
+import hashlib
+import json
+import math
+import sys
+import time
+import zlib
 import psycopg2
-import redis
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from multiprocessing.util import Finalize
+from psycopg2.extras import execute_values
+from connections import REDIS_CONFIG, acquire_pg, close_all, get_redis, release_pg
+import redis_layout
 
-POSTGRES_CONFIG = {
-    "host": "192.168.50.24",
-    "database": "demo",
-    "user": "postgres",
-    "password": "postgres"
-}
+# Параметры пакетной обработки
+SCAN_COUNT = 1000   # подсказка COUNT для SCAN
+BATCH_SIZE = 500    # ключей на один pipeline HGETALL и один INSERT
+
+# Контрольные точки инкрементального режима и поток изменённых ключей
+CHECKPOINT_KEY = "migration:checkpoint"
+CHANGES_STREAM = redis_layout.CHANGES_STREAM
+# Отклонённые записи вместе с причиной
+DEAD_LETTER_STREAM = "migration:dead_letter"
+
+# Индекс book_ref для проверки билетов: выше порога вместо множества - фильтр Блума
+BLOOM_THRESHOLD = 5_000_000
+BLOOM_ERROR_RATE = 0.001
+INDEX_ITERSIZE = 50_000
+
+# Раскладка данных в Redis: keys - хэш на запись, sharded - шарды redis_layout
+LAYOUTS = ('keys', 'sharded')
+
+def parse_booking(data):
+    return (
+        data['book_ref'],
+        datetime.strptime(data['book_date'], '%Y-%m-%d').date(),
+        float(data['total_amount'])
+    )
+
+def parse_flight(data):
+    return (
+        data['flight_id'],
+        data['flight_no'],
+        datetime.strptime(data['scheduled_departure'], '%Y-%m-%dT%H:%M:%S'),
+        datetime.strptime(data['scheduled_arrival'], '%Y-%m-%dT%H:%M:%S')
+    )
 
-REDIS_CONFIG = {
-    "host": "192.168.50.24",
-    "port": 6379,
-    "db": 0,
-    "decode_responses": True
+def parse_ticket(data):
+    return (
+        data['ticket_no'],
+        data['book_ref'],
+        data['passenger_name'],
+        data['contact_data']
+    )
+
+# Описание переносимых сущностей: шаблон ключей, разбор хэша и многострочный INSERT
+ENTITIES = {
+    'bookings': {
+        'pattern': "booking:*",
+        'label': "бронировании",
+        'parse': parse_booking,
+        'sql': """INSERT INTO bookings
+            (book_ref, book_date, total_amount)
+            VALUES %s
+            ON CONFLICT (book_ref) DO NOTHING""",
+        'upsert': """INSERT INTO bookings
+            (book_ref, book_date, total_amount)
+            VALUES %s
+            ON CONFLICT (book_ref) DO UPDATE SET
+                book_date = EXCLUDED.book_date,
+                total_amount = EXCLUDED.total_amount"""
+    },
+    'flights': {
+        'pattern': "flight:*",
+        'label': "рейсе",
+        'parse': parse_flight,
+        'sql': """INSERT INTO flights
+            (flight_id, flight_no, scheduled_departure, scheduled_arrival)
+            VALUES %s
+            ON CONFLICT (flight_id) DO NOTHING""",
+        'upsert': """INSERT INTO flights
+            (flight_id, flight_no, scheduled_departure, scheduled_arrival)
+            VALUES %s
+            ON CONFLICT (flight_id) DO UPDATE SET
+                flight_no = EXCLUDED.flight_no,
+                scheduled_departure = EXCLUDED.scheduled_departure,
+                scheduled_arrival = EXCLUDED.scheduled_arrival"""
+    },
+    'tickets': {
+        'pattern': "ticket:*",
+        'label': "билете",
+        'parse': parse_ticket,
+        'sql': """INSERT INTO tickets
+            (ticket_no, book_ref, passenger_name, contact_data)
+            VALUES %s
+            ON CONFLICT (ticket_no) DO NOTHING""",
+        'upsert': """INSERT INTO tickets
+            (ticket_no, book_ref, passenger_name, contact_data)
+            VALUES %s
+            ON CONFLICT (ticket_no) DO UPDATE SET
+                book_ref = EXCLUDED.book_ref,
+                passenger_name = EXCLUDED.passenger_name,
+                contact_data = EXCLUDED.contact_data"""
+    }
 }
 
-def redis_to_postgres():
-    """Перенос данных из Redis в PostgreSQL"""
-    pg_conn = psycopg2.connect(**POSTGRES_CONFIG)
-    redis_conn = redis.Redis(**REDIS_CONFIG)
-    
+def key_bucket(key, buckets):
+    """Номер хэш-корзины ключа для разбиения ключевого пространства между процессами"""
+    return zlib.crc32(key.encode()) % buckets
+
+def entity_for_key(key):
+    """Сущность, к которой относится ключ Redis (по префиксу шаблона)"""
+    for entity, spec in ENTITIES.items():
+        if key.startswith(spec['pattern'].rstrip('*')):
+            return entity
+    return None
+
+def checkpoint_field(entity, bucket=None):
+    number, total = bucket or (0, 1)
+    return f"{entity}:{number}/{total}"
+
+def layout_checkpoint_field(entity, bucket=None, layout='keys'):
+    field = checkpoint_field(entity, bucket)
+    if layout != 'keys':
+        # Курсоры раскладок несовместимы - у каждой свои контрольные точки
+        field = f"{layout}:{field}"
+    return field
+
+def load_checkpoint(redis_conn, field):
+    raw = redis_conn.hget(CHECKPOINT_KEY, field)
+    return json.loads(raw) if raw else None
+
+def save_checkpoint(redis_conn, field, **state):
+    redis_conn.hset(CHECKPOINT_KEY, field, json.dumps(state))
+
+def entity_done(redis_conn, entity, workers=1, layout='keys'):
+    """Все корзины сущности перенесены по контрольным точкам"""
+    buckets = [(bucket, workers) for bucket in range(workers)] if workers > 1 else [None]
+    for bucket in buckets:
+        state = load_checkpoint(redis_conn, layout_checkpoint_field(entity, bucket, layout))
+        if not (state and state['done']):
+            return False
+    return True
+
+def scan_batches(redis_conn, pattern, scan_count=SCAN_COUNT, batch_size=BATCH_SIZE,
+                 bucket=None, cursor=0):
+    """Неблокирующий обход ключей через SCAN, пачками не меньше batch_size.
+
+    Пачки собираются из целых страниц SCAN, поэтому вместе с пачкой
+    отдаётся курсор, с которого можно продолжить обход после неё
+    (0 - обход завершён). bucket=(номер, всего) оставляет только
+    ключи своей хэш-корзины.
+    """
+    batch = []
+    while True:
+        cursor, keys = redis_conn.scan(cursor, match=pattern, count=scan_count)
+        for key in keys:
+            if bucket and key_bucket(key, bucket[1]) != bucket[0]:
+                continue
+            batch.append(key)
+        if cursor == 0:
+            break
+        if len(batch) >= batch_size:
+            yield cursor, batch
+            batch = []
+    yield 0, batch
+
+def fetch_hashes(redis_conn, keys):
+    """HGETALL для пачки ключей за один round trip"""
+    pipe = redis_conn.pipeline(transaction=False)
+    for key in keys:
+        pipe.hgetall(key)
+    return list(zip(keys, pipe.execute()))
+
+def send_to_dead_letter(redis_conn, rejected):
+    """Запись отклонённых записей в поток DEAD_LETTER_STREAM одним pipeline"""
+    pipe = redis_conn.pipeline(transaction=False)
+    for entity, key, reason, data in rejected:
+        pipe.xadd(DEAD_LETTER_STREAM, {
+            'entity': entity,
+            'key': key,
+            'reason': reason,
+            'data': json.dumps(data, default=str, ensure_ascii=False)
+        })
+    pipe.execute()
+
+class BloomFilter:
+    """Фильтр Блума на bytearray с двойным хэшированием blake2b"""
+
+    def __init__(self, capacity, error_rate=BLOOM_ERROR_RATE):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for pos in self._positions(value):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, value):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(value))
+
+class BookingIndex:
+    """Известные book_ref в памяти для проверки билетов без запросов к PostgreSQL.
+
+    Для небольших таблиц - точное множество. Для больших - фильтр Блума:
+    отрицательный ответ точен, а редкие ложноположительные попадания
+    отсекает внешний ключ tickets -> bookings в PostgreSQL, и write_batch
+    отправляет такие строки в поток отклонённых.
+
+    Таблица bookings читается лениво - при первой проверке билета, так что
+    запуски без билетов к переносу (все контрольные точки done) её не сканируют.
+    """
+
+    def __init__(self, bloom_threshold=BLOOM_THRESHOLD):
+        self.bloom_threshold = bloom_threshold
+        self.refs = set()
+        # Счётчик нужен только фильтру Блума: у множества размер - len(refs)
+        self.bloom_count = 0
+        self.seeded = False
+
+    def seed(self):
+        """Заполнение индекса из таблицы bookings серверным курсором.
+
+        Отдельное соединение пула: коммит чтения не должен зафиксировать
+        незавершённую транзакцию переноса. Записанные ею бронирования уже
+        добавлены в индекс через remember_bookings.
+        """
+        pg_conn = acquire_pg()
+        try:
+            with pg_conn.cursor() as cursor:
+                cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = 'bookings'::regclass")
+                estimate = cursor.fetchone()[0]
+            if estimate > self.bloom_threshold:
+                # Запас на бронирования, добавляемые в ходе переноса
+                remembered = self.refs
+                self.refs = BloomFilter(int(estimate * 1.2))
+                for book_ref in remembered:
+                    self.add(book_ref)
+
+            with pg_conn.cursor(name="booking_index") as cursor:
+                cursor.itersize = INDEX_ITERSIZE
+                cursor.execute("SELECT book_ref FROM bookings")
+                for (book_ref,) in cursor:
+                    self.add(book_ref)
+            pg_conn.commit()
+        finally:
+            release_pg(pg_conn)
+        self.seeded = True
+
+    def add(self, book_ref):
+        if isinstance(self.refs, BloomFilter):
+            # Повторы (и редкие ложноположительные) не увеличивают счётчик
+            if book_ref in self.refs:
+                return
+            self.bloom_count += 1
+        self.refs.add(book_ref)
+
+    def __len__(self):
+        """Число book_ref в индексе (для фильтра Блума - оценка снизу)"""
+        if isinstance(self.refs, BloomFilter):
+            return self.bloom_count
+        return len(self.refs)
+
+    def __contains__(self, book_ref):
+        if not self.seeded:
+            self.seed()
+        return book_ref in self.refs
+
+    def memory_bytes(self):
+        if isinstance(self.refs, BloomFilter):
+            return sys.getsizeof(self.refs.bits)
+        return sys.getsizeof(self.refs) + sum(sys.getsizeof(ref) for ref in self.refs)
+
+    def describe(self):
+        if not self.seeded:
+            return "Индекс бронирований: не заполнялся (билеты не проверялись)"
+        kind = "фильтр Блума" if isinstance(self.refs, BloomFilter) else "множество"
+        return (f"Индекс бронирований: {kind}, {len(self)} book_ref, "
+                f"{self.memory_bytes() / 1024 / 1024:.1f} МБ")
+
+def remember_bookings(booking_index, items, rejected):
+    """Добавление записанных бронирований пачки в индекс"""
+    failed = {key for _, key, _, _ in rejected}
+    for key, row in items:
+        if key not in failed:
+            booking_index.add(row[0])
+
+def known_bookings(cursor, book_refs):
+    """book_ref из списка, которые есть в bookings (видны и незафиксированные записи cursor)"""
+    if not book_refs:
+        return set()
+    cursor.execute("SELECT book_ref FROM bookings WHERE book_ref = ANY(%s)", (list(book_refs),))
+    return {book_ref for (book_ref,) in cursor.fetchall()}
+
+def filter_known_bookings(booking_index, items, stats, rejected):
+    """Проверка бронирований для пачки билетов по индексу в памяти (или множеству)"""
+    result = []
+    for key, row in items:
+        if row[1] in booking_index:
+            result.append((key, row))
+        else:
+            rejected.append(('tickets', key, f"Бронирование {row[1]} не найдено", row))
+            stats['errors'] += 1
+    return result
+
+def fetch_batch(redis_conn, entity, keys, layout='keys'):
+    """Записи по именам ключей в выбранной раскладке"""
+    if layout == 'sharded':
+        return redis_layout.fetch_records(redis_conn, entity, keys)
+    return fetch_hashes(redis_conn, keys)
+
+def parse_items(entity, records, stats, rejected, booking_index=None):
+    """Разбор пачки записей; для билетов - с проверкой бронирований"""
+    spec = ENTITIES[entity]
+    items = []
+    for key, data in records:
+        if not data:
+            # Ключ удалён между SCAN/XREAD и HGETALL
+            continue
+        try:
+            items.append((key, spec['parse'](data)))
+        except Exception as e:
+            stats['errors'] += 1
+            rejected.append((entity, key, f"Ошибка в {spec['label']}: {str(e)}", data))
+    stats['processed'] += len(records)
+
+    if entity == 'tickets' and items:
+        items = filter_known_bookings(booking_index, items, stats, rejected)
+    return items
+
+def record_batches(redis_conn, entity, scan_count=SCAN_COUNT, batch_size=BATCH_SIZE,
+                   bucket=None, cursor=0, layout='keys'):
+    """Пачки (курсор, записи) в выбранной раскладке.
+
+    Для sharded курсор - номер следующего шарда, для keys - курсор SCAN;
+    в обоих случаях 0 означает конец обхода.
+    """
+    if layout == 'sharded':
+        yield from redis_layout.shard_batches(redis_conn, entity, batch_size, bucket, cursor)
+        return
+    pattern = ENTITIES[entity]['pattern']
+    for cursor, keys in scan_batches(redis_conn, pattern, scan_count, batch_size,
+                                     bucket, cursor):
+        yield cursor, fetch_hashes(redis_conn, keys)
+
+def write_batch(cursor, entity, sql, items, stats, rejected):
+    """Запись пачки под SAVEPOINT.
+
+    Если пачка не записалась, откатываемся к точке сохранения и делим её
+    пополам, пока сбойная строка не останется одна - она уходит в
+    rejected, а остальные строки пачки записываются.
+    """
+    cursor.execute("SAVEPOINT batch")
     try:
-        with pg_conn.cursor() as cursor:
-            counters = {
-                'bookings': 0,
-                'tickets': 0, 
-                'flights': 0,
-                'errors': 0
-            }
-
-            # 1. Обработка бронирований
-            for key in redis_conn.keys("booking:*"):
-                try:
-                    data = redis_conn.hgetall(key)
-                    
-                    # Проверка существующей записи
-                    cursor.execute(
-                        "SELECT 1 FROM bookings WHERE book_ref = %s LIMIT 1",
-                        (data['book_ref'],)
-                    )
-                    
-                    if not cursor.fetchone():
-                        cursor.execute(
-                            """INSERT INTO bookings 
-                            (book_ref, book_date, total_amount)
-                            VALUES (%s, %s, %s)""",
-                            (
-                                data['book_ref'],
-                                datetime.strptime(data['book_date'], '%Y-%m-%d').date(),
-                                float(data['total_amount'])
-                            )
-                        )
-                        counters['bookings'] += 1
-                        
-                except Exception as e:
-                    counters['errors'] += 1
-                    print(f"Ошибка в бронировании {key}: {str(e)}")
-
-            # 2. Обработка рейсов
-            for key in redis_conn.keys("flight:*"):
-                try:
-                    data = redis_conn.hgetall(key)
-                    
-                    cursor.execute(
-                        "SELECT 1 FROM flights WHERE flight_id = %s LIMIT 1",
-                        (data['flight_id'],)
-                    )
-                    
-                    if not cursor.fetchone():
-                        cursor.execute(
-                            """INSERT INTO flights 
-                            (flight_id, flight_no, scheduled_departure, scheduled_arrival)
-                            VALUES (%s, %s, %s, %s)""",
-                            (
-                                data['flight_id'],
-                                data['flight_no'],
-                                datetime.strptime(data['scheduled_departure'], '%Y-%m-%dT%H:%M:%S'),
-                                datetime.strptime(data['scheduled_arrival'], '%Y-%m-%dT%H:%M:%S')
-                            )
-                        )
-                        counters['flights'] += 1
-                        
-                except Exception as e:
-                    counters['errors'] += 1
-                    print(f"Ошибка в рейсе {key}: {str(e)}")
-
-            # 3. Обработка билетов
-            for key in redis_conn.keys("ticket:*"):
-                try:
-                    data = redis_conn.hgetall(key)
-                    
-                    # Проверка существования бронирования
-                    cursor.execute(
-                        "SELECT 1 FROM bookings WHERE book_ref = %s LIMIT 1",
-                        (data['book_ref'],)
-                    )
-                    
-                    if not cursor.fetchone():
-                        print(f"Бронирование {data['book_ref']} не найдено для билета {key}")
-                        counters['errors'] += 1
-                        continue
-                        
-                    cursor.execute(
-                        """INSERT INTO tickets 
-                        (ticket_no, book_ref, passenger_name, contact_data)
-                        VALUES (%s, %s, %s, %s)
-                        ON CONFLICT (ticket_no) DO NOTHING""",
-                        (
-                            data['ticket_no'],
-                            data['book_ref'],
-                            data['passenger_name'],
-                            data['contact_data']
-                        )
-                    )
-                    if cursor.rowcount > 0:
-                        counters['tickets'] += 1
-                        
-                except Exception as e:
-                    counters['errors'] += 1
-                    print(f"Ошибка в билете {key}: {str(e)}")
+        rows = [row for _, row in items]
+        execute_values(cursor, sql, rows, page_size=len(rows))
+        stats['inserted'] += cursor.rowcount
+        cursor.execute("RELEASE SAVEPOINT batch")
+    except psycopg2.Error as e:
+        cursor.execute("ROLLBACK TO SAVEPOINT batch")
+        cursor.execute("RELEASE SAVEPOINT batch")
+        if len(items) == 1:
+            key, row = items[0]
+            stats['errors'] += 1
+            rejected.append((entity, key, str(e).strip(), row))
+            return
+        middle = len(items) // 2
+        write_batch(cursor, entity, sql, items[:middle], stats, rejected)
+        write_batch(cursor, entity, sql, items[middle:], stats, rejected)
+
+def migrate_entity(cursor, redis_conn, entity, scan_count=SCAN_COUNT, batch_size=BATCH_SIZE,
+                   bucket=None, incremental=False, booking_index=None, layout='keys'):
+    """Пакетный перенос одной сущности: SCAN -> pipeline HGETALL -> многострочный INSERT.
+
+    В инкрементальном режиме каждая пачка фиксируется отдельно, а после
+    неё в Redis сохраняется контрольная точка (курсор SCAN и число
+    зафиксированных пачек), с которой продолжится прерванный перенос.
+    """
+    spec = ENTITIES[entity]
+    stats = {'inserted': 0, 'errors': 0, 'processed': 0}
+
+    field = layout_checkpoint_field(entity, bucket, layout)
+    state = load_checkpoint(redis_conn, field) if incremental else None
+    if state and state['done']:
+        return stats
+    scan_cursor = state['cursor'] if state else 0
+    batches = state['batches'] if state else 0
+
+    for scan_cursor, records in record_batches(redis_conn, entity, scan_count, batch_size,
+                                               bucket, scan_cursor, layout):
+        rejected = []
+        items = parse_items(entity, records, stats, rejected, booking_index)
+        if items:
+            write_batch(cursor, entity, spec['sql'], items, stats, rejected)
+            if entity == 'bookings' and booking_index is not None:
+                remember_bookings(booking_index, items, rejected)
+        if rejected:
+            send_to_dead_letter(redis_conn, rejected)
+
+        if incremental:
+            # Сначала фиксируем пачку, потом сдвигаем контрольную точку:
+            # после сбоя между ними пачка повторится, а ON CONFLICT сделает повтор безопасным
+            cursor.connection.commit()
+            batches += 1
+            save_checkpoint(redis_conn, field, cursor=scan_cursor, batches=batches,
+                            done=scan_cursor == 0)
+
+    return stats
+
+def sync_changes(pg_conn, redis_conn, batch_size=BATCH_SIZE, booking_index=None, layout='keys'):
+    """Применение потока изменённых ключей: upsert только того, что поменялось.
+
+    В раскладке sharded поток пополняет не watch_keyspace, а
+    redis_layout.write_records: он пишет имена исходных ключей записей
+    (booking:<book_ref> и т.д.), которые разрешает redis_layout.fetch_records.
+
+    Бронирования билетов пачки проверяются одним запросом book_ref = ANY(...),
+    а не полным индексом - стабильная синхронизация трогает только изменённое.
+    booking_index, если передан, лишь пополняется записанными бронированиями.
+    """
+    stats = {entity: 0 for entity in ENTITIES}
+    stats.update({'errors': 0, 'processed': 0})
+    state = load_checkpoint(redis_conn, 'changes')
+    last_id = state['stream_id'] if state else '0-0'
+
+    with pg_conn.cursor() as cursor:
+        while True:
+            response = redis_conn.xread({CHANGES_STREAM: last_id}, count=batch_size)
+            if not response:
+                break
+            entries = response[0][1]
+
+            changed = {entity: set() for entity in ENTITIES}
+            for _, fields in entries:
+                entity = entity_for_key(fields.get('key', ''))
+                if entity:
+                    changed[entity].add(fields['key'])
+
+            # Бронирования раньше билетов той же пачки
+            for entity in ('bookings', 'flights', 'tickets'):
+                if not changed[entity]:
+                    continue
+                entity_stats = {'inserted': 0, 'errors': 0, 'processed': 0}
+                rejected = []
+                records = fetch_batch(redis_conn, entity, sorted(changed[entity]), layout)
+                known = None
+                if entity == 'tickets':
+                    # Бронирования этой пачки уже записаны тем же курсором
+                    known = known_bookings(cursor, {data['book_ref'] for _, data in records
+                                                    if data.get('book_ref')})
+                items = parse_items(entity, records, entity_stats, rejected, known)
+                if items:
+                    write_batch(cursor, entity, ENTITIES[entity]['upsert'], items,
+                                entity_stats, rejected)
+                    if entity == 'bookings' and booking_index is not None:
+                        remember_bookings(booking_index, items, rejected)
+                if rejected:
+                    send_to_dead_letter(redis_conn, rejected)
+                stats[entity] += entity_stats['inserted']
+                stats['errors'] += entity_stats['errors']
+                stats['processed'] += entity_stats['processed']
 
             pg_conn.commit()
-            print("\nРезультаты переноса:")
-            print(f"Добавлено бронирований: {counters['bookings']}")
-            print(f"Добавлено рейсов: {counters['flights']}")
-            print(f"Добавлено билетов: {counters['tickets']}")
-            print(f"Всего ошибок: {counters['errors']}")
+            last_id = entries[-1][0]
+            save_checkpoint(redis_conn, 'changes', stream_id=last_id)
+            redis_conn.xtrim(CHANGES_STREAM, minid=last_id)
+
+    return stats
+
+def watch_keyspace(redis_conn):
+    """Перекладывание keyspace-уведомлений об изменении хэшей в поток изменений.
+
+    Pub/Sub не хранит сообщения, поэтому уведомления сразу переносятся
+    в Redis Stream, откуда их читает sync_changes. Только для раскладки
+    keys: уведомление о шарде не говорит, какая запись изменилась.
+    """
+    current = redis_conn.config_get('notify-keyspace-events').get('notify-keyspace-events', '')
+    redis_conn.config_set('notify-keyspace-events', ''.join(sorted(set(current) | {'K', 'h'})))
+
+    db = REDIS_CONFIG['db']
+    pubsub = redis_conn.pubsub()
+    pubsub.psubscribe(*[f"__keyspace@{db}__:{spec['pattern']}" for spec in ENTITIES.values()])
+    print(f"Изменения пишутся в поток {CHANGES_STREAM}")
+    for message in pubsub.listen():
+        if message['type'] == 'pmessage':
+            key = message['channel'].split(':', 1)[1]
+            redis_conn.xadd(CHANGES_STREAM, {'key': key})
+
+# Соединения рабочего процесса (у каждого процесса свои)
+_worker = {}
+
+def init_worker(booking_index=None):
+    """Открытие собственных подключений к PostgreSQL и Redis в рабочем процессе"""
+    _worker['pg_conn'] = acquire_pg()
+    _worker['redis_conn'] = get_redis(decode_responses=True)
+    _worker['booking_index'] = booking_index
+    # Рабочие процессы завершаются без atexit - пулы закрываем сами
+    Finalize(None, close_all, exitpriority=10)
+
+def migrate_partition(entity, bucket, workers, scan_count, batch_size, incremental=False,
+                      layout='keys'):
+    """Перенос одной хэш-корзины сущности в рабочем процессе"""
+    pg_conn = _worker['pg_conn']
+    try:
+        with pg_conn.cursor() as cursor:
+            stats = migrate_entity(cursor, _worker['redis_conn'], entity,
+                                   scan_count, batch_size, (bucket, workers), incremental,
+                                   _worker['booking_index'], layout)
+        pg_conn.commit()
+        return stats
+    except Exception:
+        pg_conn.rollback()
+        raise
+
+def new_counters():
+    return {
+        'bookings': 0,
+        'tickets': 0,
+        'flights': 0,
+        'errors': 0
+    }
+
+def print_report(counters, rates):
+    print("\nРезультаты переноса:")
+    print(f"Добавлено бронирований: {counters['bookings']}")
+    print(f"Добавлено рейсов: {counters['flights']}")
+    print(f"Добавлено билетов: {counters['tickets']}")
+    print(f"Всего ошибок: {counters['errors']}")
+    if counters['errors']:
+        print(f"Отклонённые записи с причинами: поток {DEAD_LETTER_STREAM}")
+    print("\nСкорость обработки:")
+    for entity, rate in rates.items():
+        print(f"{entity}: {rate:.0f} строк/сек")
+
+def run_parallel(redis_conn, workers, scan_count=SCAN_COUNT, batch_size=BATCH_SIZE,
+                 incremental=False, layout='keys'):
+    """Параллельный перенос: ключи делятся на хэш-корзины между рабочими процессами.
+
+    Бронирования и рейсы загружаются одновременно, билеты стартуют
+    только после завершения всех корзин бронирований - в отдельном пуле,
+    процессы которого получают уже заполненный индекс book_ref.
+    """
+    counters = new_counters()
+    processed = {'bookings': 0, 'flights': 0, 'tickets': 0}
+    started = {}
+    finished = {}
+
+    def submit(pool, entity, bucket):
+        future = pool.submit(migrate_partition, entity, bucket, workers, scan_count,
+                             batch_size, incremental, layout)
+        future.add_done_callback(
+            lambda _: finished.__setitem__(entity, time.perf_counter())
+        )
+        return future
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+        futures = {'bookings': [], 'flights': []}
+        started['bookings'] = started['flights'] = time.perf_counter()
+        # Чередуем корзины, чтобы обе сущности загружались одновременно
+        for bucket in range(workers):
+            futures['bookings'].append(submit(pool, 'bookings', bucket))
+            futures['flights'].append(submit(pool, 'flights', bucket))
+
+        # Билеты ждут успешного завершения всех корзин бронирований
+        for future in futures['bookings']:
+            future.result()
+        booking_index = BookingIndex()
+        if not (incremental and entity_done(redis_conn, 'tickets', workers, layout)):
+            # Заполняем один раз здесь, а не в каждом процессе
+            booking_index.seed()
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(booking_index,)) as tickets_pool:
+            started['tickets'] = time.perf_counter()
+            futures['tickets'] = [submit(tickets_pool, 'tickets', bucket)
+                                  for bucket in range(workers)]
+
+            for entity in ('bookings', 'flights', 'tickets'):
+                for future in futures[entity]:
+                    stats = future.result()
+                    counters[entity] += stats['inserted']
+                    counters['errors'] += stats['errors']
+                    processed[entity] += stats['processed']
+
+    rates = {}
+    for entity in ('bookings', 'flights', 'tickets'):
+        duration = finished[entity] - started[entity]
+        rates[entity] = processed[entity] / duration if duration else 0.0
+    return counters, rates, booking_index
+
+def run_sequential(pg_conn, redis_conn, scan_count=SCAN_COUNT, batch_size=BATCH_SIZE,
+                   incremental=False, layout='keys'):
+    """Последовательный перенос: бронирования, рейсы, затем билеты"""
+    counters = new_counters()
+    rates = {}
+    # Заполнится при первой проверке билета
+    booking_index = BookingIndex()
+
+    with pg_conn.cursor() as cursor:
+        for entity in ('bookings', 'flights', 'tickets'):
+            start_time = time.perf_counter()
+            stats = migrate_entity(cursor, redis_conn, entity, scan_count, batch_size,
+                                   incremental=incremental, booking_index=booking_index,
+                                   layout=layout)
+            duration = time.perf_counter() - start_time
+
+            counters[entity] += stats['inserted']
+            counters['errors'] += stats['errors']
+            rates[entity] = stats['processed'] / duration if duration else 0.0
+
+    pg_conn.commit()
+    return counters, rates, booking_index
+
+def redis_to_postgres(scan_count=SCAN_COUNT, batch_size=BATCH_SIZE, workers=1,
+                      incremental=False, layout='keys'):
+    """Перенос данных из Redis в PostgreSQL"""
+    pg_conn = acquire_pg()
+    redis_conn = get_redis(decode_responses=True)
+
+    try:
+        if workers > 1:
+            counters, rates, booking_index = run_parallel(redis_conn, workers, scan_count,
+                                                          batch_size, incremental, layout)
+        else:
+            counters, rates, booking_index = run_sequential(pg_conn, redis_conn, scan_count,
+                                                            batch_size, incremental, layout)
+
+        if incremental:
+            start_time = time.perf_counter()
+            changes = sync_changes(pg_conn, redis_conn, batch_size, booking_index, layout)
+            duration = time.perf_counter() - start_time
+            for name in ('bookings', 'flights', 'tickets', 'errors'):
+                counters[name] += changes[name]
+            rates['changes'] = changes['processed'] / duration if duration else 0.0
+
+        print_report(counters, rates)
+        print(booking_index.describe())
 
     except Exception as e:
         pg_conn.rollback()
         print(f"Критическая ошибка: {str(e)}")
     finally:
-        pg_conn.close()
-        redis_conn.close()
+        release_pg(pg_conn)
 
 if __name__ == "__main__":
-    redis_to_postgres()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Перенос данных из Redis в PostgreSQL")
+    parser.add_argument("--scan-count", type=int, default=SCAN_COUNT,
+                        help="подсказка COUNT для SCAN")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help="ключей в одном pipeline HGETALL и одном INSERT")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="число рабочих процессов (1 - без параллелизма)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="фиксация по пачкам с контрольными точками и чтение потока изменений")
+    parser.add_argument("--layout", choices=LAYOUTS, default='keys',
+                        help="раскладка данных в Redis: хэш на запись или шарды redis_layout")
+    parser.add_argument("--reset-checkpoint", action="store_true",
+                        help="удалить контрольные точки и начать полный обход заново")
+    parser.add_argument("--watch", action="store_true",
+                        help="писать keyspace-уведомления об изменениях в поток изменений")
+    args = parser.parse_args()
+    if args.watch and args.layout == 'sharded':
+        parser.error("--watch работает только с --layout keys: изменения шардов "
+                     "пишет в поток redis_layout.write_records")
+
+    if args.reset_checkpoint or args.watch:
+        redis_conn = get_redis(decode_responses=True)
+        if args.reset_checkpoint:
+            redis_conn.delete(CHECKPOINT_KEY)
+        if args.watch:
+            watch_keyspace(redis_conn)
+
+    if not args.watch:
+        redis_to_postgres(scan_count=args.scan_count, batch_size=args.batch_size,
+                          workers=args.workers, incremental=args.incremental,
+                          layout=args.layout)
@@ -1,57 +1,222 @@
-from pymongo import MongoClient
-
-# Конфигурация подключения
-MONGO_CONFIG = {
-   "host": "192.168.50.24",
-    "port": 27017,
-    "username": "root",      # Добавляем имя пользователя
-    "password": "root",  # Добавляем пароль
-    "authSource": "admin",              # Указываем базу аутентификации
-}
+import argparse
+import statistics
+import time
+from datetime import timedelta
+from connections import get_mongo
+import mongo_read
 
-def airports_aggregation():
-    client = MongoClient(**MONGO_CONFIG)
-    db = client.airline_database
-    airports = db.airports
+BENCHMARK_REPEATS = 10
+
+# Материализованная статистика моделей самолётов и её промежуточный слой
+# (модель x аэропорт), плюс водяные знаки инкрементального обновления
+MODEL_STATS = "aircraft_model_stats"
+MODEL_STATS_BY_AIRPORT = "aircraft_model_stats_by_airport"
+MATERIALIZATION_STATE = "materialization_state"
+# Водяной знак сдвигается назад на этот запас: запись, получившая $$NOW
+# раньше уже прочитанной, но видимая позже неё, попадёт в следующее обновление
+WATERMARK_LAG = timedelta(seconds=5)
+
+# Агрегация по коллекции airports: $unwind каждого рейса каждого аэропорта
+ARRAY_PIPELINE = [
+    # 1. Разворачиваем массив рейсов
+    {"$unwind": "$flights"},
+
+    # 2. Проекция для извлечения нужных полей
+    {"$project": {
+        "_id": 0,
+        "airport_code": 1,
+        "airport_name": 1,
+        "flight_no": "$flights.flight_no",
+        "departure_time": "$flights.departure_time",
+        "aircraft_model": "$flights.aircraft",
+        "destination": "$flights.arrival_airport"
+    }},
+
+    # 3. Группировка по модели самолета
+    {"$group": {
+        "_id": "$aircraft_model",
+        "total_flights": {"$sum": 1},
+        "airports": {"$addToSet": "$airport_code"},
+        # Последний по времени вылета рейс - как в BUCKETS_PIPELINE, не зависит от порядка
+        "last": {"$max": {"departure": "$departure_time", "flight_no": "$flight_no"}}
+    }},
+
+    # 4. Сортировка по количеству рейсов
+    {"$sort": {"total_flights": -1}},
+
+    # 5. Ограничение вывода
+    {"$limit": 5},
+    {"$set": {"last_flight": "$last.flight_no"}},
+    {"$unset": "last"}
+]
 
-    pipeline = [
-        # 1. Разворачиваем массив рейсов
+# Та же агрегация по airport_buckets: разворачиваются только счётчики
+# моделей (несколько на документ), массивы рейсов не читаются вовсе
+BUCKETS_PIPELINE = [
+    {"$project": {"_id": 0, "airport_code": 1, "models": 1}},
+    {"$unwind": "$models"},
+    {"$group": {
+        "_id": "$models.model",
+        "total_flights": {"$sum": "$models.flights"},
+        "airports": {"$addToSet": "$airport_code"},
+        # Последний по времени вылета рейс модели: $max сравнивает документы по полям
+        "last": {"$max": {"departure": "$models.last_departure",
+                          "flight_no": "$models.last_flight"}}
+    }},
+    {"$sort": {"total_flights": -1}},
+    {"$limit": 5},
+    {"$set": {"last_flight": "$last.flight_no"}},
+    {"$unset": "last"}
+]
+
+# Чтение готовой статистики: сортировка по индексу total_flights, O(моделей)
+MATERIALIZED_PIPELINE = [
+    {"$sort": {"total_flights": -1}},
+    {"$limit": 5},
+    {"$project": {"total_flights": 1, "airports": 1, "last_flight": 1}}
+]
+
+# Раскладка -> (коллекция, конвейер)
+LAYOUTS = {
+    "array": ("airports", ARRAY_PIPELINE),
+    "buckets": ("airport_buckets", BUCKETS_PIPELINE),
+    "materialized": (MODEL_STATS, MATERIALIZED_PIPELINE)
+}
+
+# Источники статистики: коллекция и свёртка её документов до (модель, аэропорт).
+# last - последний по времени вылета рейс; $max по документу детерминирован.
+STATS_SOURCES = {
+    "array": ("airports", [
         {"$unwind": "$flights"},
-        
-        # 2. Проекция для извлечения нужных полей
-        {"$project": {
-            "_id": 0,
-            "airport_code": 1,
-            "airport_name": 1,
-            "flight_no": "$flights.flight_no",
-            "departure_time": "$flights.departure_time",
-            "aircraft_model": "$flights.aircraft",
-            "destination": "$flights.arrival_airport"
-        }},
-        
-        # 3. Группировка по модели самолета
         {"$group": {
-            "_id": "$aircraft_model",
-            "total_flights": {"$sum": 1},
-            "airports": {"$addToSet": "$airport_code"},
-            "last_flight": {"$last": "$flight_no"}
+            "_id": {"model": "$flights.aircraft", "airport_code": "$airport_code"},
+            "flights": {"$sum": 1},
+            "last": {"$max": {"departure": "$flights.departure_time",
+                              "flight_no": "$flights.flight_no"}}
+        }}
+    ]),
+    "buckets": ("airport_buckets", [
+        {"$unwind": "$models"},
+        {"$group": {
+            "_id": {"model": "$models.model", "airport_code": "$airport_code"},
+            "flights": {"$sum": "$models.flights"},
+            "last": {"$max": {"departure": "$models.last_departure",
+                              "flight_no": "$models.last_flight"}}
+        }}
+    ])
+}
+
+def refresh_model_stats(db, source="array", full=False):
+    """Инкрементальное обновление aircraft_model_stats через $merge.
+
+    Берутся только аэропорты, документы которых изменились с прошлого
+    обновления (updated_at >= водяного знака). Их вклад в слой
+    модель x аэропорт пересчитывается целиком и заменяет прежний, затем
+    итог пересчитывается только для затронутых моделей. Повторная
+    обработка аэропорта безопасна, поэтому граница водяного знака
+    включается ($gte) и сдвигается на WATERMARK_LAG назад - документы,
+    записанные в ту же миллисекунду или одновременно с обновлением,
+    не теряются. updated_at ставит сервер ($$NOW) при upsert в
+    mongodb-second.py, по нему есть индекс.
+    """
+    collection, per_airport = STATS_SOURCES[source]
+    state_id = f"{MODEL_STATS}:{source}"
+    by_airport = db[MODEL_STATS_BY_AIRPORT]
+    stats = db[MODEL_STATS]
+    by_airport.create_index("_id.airport_code")
+    stats.create_index([("total_flights", -1)])
+
+    state = None if full else db[MATERIALIZATION_STATE].find_one({"_id": state_id})
+    if full:
+        by_airport.delete_many({})
+        stats.delete_many({})
+    match = {"updated_at": {"$gte": state["watermark"]}} if state else {}
+
+    changed = list(db[collection].aggregate([
+        {"$match": match},
+        {"$group": {"_id": None,
+                    "airports": {"$addToSet": "$airport_code"},
+                    "watermark": {"$max": "$updated_at"}}}
+    ]))
+    if not changed:
+        print("Изменённых аэропортов нет")
+        return set()
+    airports = changed[0]["airports"]
+    in_airports = {"_id.airport_code": {"$in": airports}}
+
+    # Вклад изменённых аэропортов: старый удаляем, новый пишем через $merge
+    touched = set(by_airport.distinct("_id.model", in_airports))
+    by_airport.delete_many(in_airports)
+    db[collection].aggregate([
+        {"$match": {"airport_code": {"$in": airports}}},
+        *per_airport,
+        {"$merge": {"into": MODEL_STATS_BY_AIRPORT,
+                    "whenMatched": "replace", "whenNotMatched": "insert"}}
+    ])
+    touched |= set(by_airport.distinct("_id.model", in_airports))
+
+    # Итог только по затронутым моделям
+    by_airport.aggregate([
+        {"$match": {"_id.model": {"$in": list(touched)}}},
+        {"$group": {
+            "_id": "$_id.model",
+            "total_flights": {"$sum": "$flights"},
+            "airports": {"$addToSet": "$_id.airport_code"},
+            "last": {"$max": "$last"}
         }},
-        
-        # 4. Сортировка по количеству рейсов
-        {"$sort": {"total_flights": -1}},
-        
-        # 5. Ограничение вывода
-        {"$limit": 5}
-    ]
+        {"$set": {"last_flight": "$last.flight_no",
+                  "last_departure": "$last.departure",
+                  "updated_at": "$$NOW"}},
+        {"$unset": "last"},
+        {"$merge": {"into": MODEL_STATS, "whenMatched": "replace", "whenNotMatched": "insert"}}
+    ])
+    remaining = set(by_airport.distinct("_id.model", {"_id.model": {"$in": list(touched)}}))
+    if touched - remaining:
+        stats.delete_many({"_id": {"$in": list(touched - remaining)}})
+
+    watermark = changed[0]["watermark"]
+    if watermark is not None:
+        # Без updated_at (данные старой миграции) водяной знак не сдвигаем
+        db[MATERIALIZATION_STATE].update_one(
+            {"_id": state_id}, {"$set": {"watermark": watermark - WATERMARK_LAG}}, upsert=True
+        )
+    print(f"Пересчитано аэропортов: {len(airports)}, моделей: {len(touched)}")
+    return touched
+
+def benchmark_layouts(db, repeats=BENCHMARK_REPEATS, read_mode="dict", batch_size=None):
+    """Время агрегации по всем раскладкам: медиана и минимум по repeats запускам"""
+    results = {}
+    for layout, (collection, pipeline) in LAYOUTS.items():
+        times = []
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            list(mongo_read.aggregate(db[collection], pipeline, read_mode, batch_size))
+            times.append(time.perf_counter() - start_time)
+        results[layout] = {
+            "documents": db[collection].estimated_document_count(),
+            "p50_ms": statistics.median(times) * 1000,
+            "min_ms": min(times) * 1000
+        }
+        print(f"{layout} ({collection}, {results[layout]['documents']} док.): "
+              f"p50 {results[layout]['p50_ms']:.1f} мс, min {results[layout]['min_ms']:.1f} мс")
+    for layout, result in results.items():
+        if layout != "array" and result["p50_ms"]:
+            print(f"Ускорение {layout}: {results['array']['p50_ms'] / result['p50_ms']:.1f}x")
+    return results
+
+def airports_aggregation(read_mode="dict", batch_size=None, layout="array"):
+    client = get_mongo()
+    db = client.airline_database
+    collection, pipeline = LAYOUTS[layout]
 
     try:
-        results = airports.aggregate(pipeline)
-        
+        results = mongo_read.aggregate(db[collection], pipeline, read_mode, batch_size)
+
         print("Топ 5 моделей самолетов по количеству рейсов:")
         print("{:<25} {:<15} {:<30} {:<10}".format(
             "Модель", "Рейсов", "Аэропорты", "Последний рейс"
         ))
-        
+
         for doc in results:
             print("{:<25} {:<15} {:<30} {:<10}".format(
                 doc['_id'],
@@ -59,11 +224,30 @@ def airports_aggregation():
                 ", ".join(doc['airports']),
                 doc['last_flight']
             ))
-            
+
     except Exception as e:
         print(f"Ошибка агрегации: {str(e)}")
-    finally:
-        client.close()
 
 if __name__ == "__main__":
-    airports_aggregation()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Агрегация рейсов по моделям самолётов")
+    mongo_read.add_read_arguments(parser)
+    parser.add_argument("--layout", choices=list(LAYOUTS), default="array",
+                        help="array - коллекция airports, buckets - airport_buckets, "
+                             "materialized - готовая aircraft_model_stats")
+    parser.add_argument("--refresh-stats", choices=list(STATS_SOURCES),
+                        help="обновить aircraft_model_stats по изменённым документам источника")
+    parser.add_argument("--full", action="store_true",
+                        help="с --refresh-stats: пересчитать статистику с нуля")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="сравнить время агрегации по всем раскладкам")
+    parser.add_argument("--repeats", type=int, default=BENCHMARK_REPEATS,
+                        help="запусков каждой агрегации в сравнении")
+    args = parser.parse_args()
+
+    if args.refresh_stats:
+        refresh_model_stats(get_mongo().airline_database, args.refresh_stats, args.full)
+    elif args.benchmark:
+        benchmark_layouts(get_mongo().airline_database, args.repeats,
+                          args.read_mode, args.batch_size)
+    else:
+        airports_aggregation(args.read_mode, args.batch_size, args.layout)
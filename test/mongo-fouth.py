@@ -1,114 +1,244 @@
-import psycopg2
-from pymongo import MongoClient, UpdateMany
-from datetime import datetime
+import argparse
 import json
 from bson import json_util
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
+from connections import get_mongo
+import mongo_read
 
-# Конфигурация подключения к PostgreSQL
-POSTGRES_CONFIG = {
-    "host": "192.168.50.24",
-    "database": "demo",
-    "user": "postgres",
-    "password": "postgres",
-    "port": "5432"
+# Документов в одном диапазоне _id для серверного обновления дат
+CHUNK_SIZE = 10000
+
+# Документы, где остались строковые даты
+STRING_DATES_FILTER = {
+    "$or": [
+        {"booking_date": {"$type": "string"}},
+        {"tickets.flights.scheduled_departure": {"$type": "string"}}
+    ]
 }
 
-# Конфигурация подключения к MongoDB
-MONGO_CONFIG = {
-   "host": "192.168.50.24",
-    "port": 27017,
-    "username": "root",      # Добавляем имя пользователя
-    "password": "root",  # Добавляем пароль
-    "authSource": "admin",              # Указываем базу аутентификации
-    "authMechanism": "SCRAM-SHA-256"    # Механизм аутентификации
+# Преобразование строк в даты на сервере, включая tickets.flights.scheduled_departure
+CONVERT_DATES_PIPELINE = [
+    {"$set": {
+        "booking_date": {"$toDate": "$booking_date"},
+        "tickets": {"$map": {
+            "input": {"$ifNull": ["$tickets", []]},
+            "as": "ticket",
+            "in": {"$mergeObjects": ["$$ticket", {
+                "flights": {"$map": {
+                    "input": {"$ifNull": ["$$ticket.flights", []]},
+                    "as": "flight",
+                    "in": {"$mergeObjects": ["$$flight", {
+                        "scheduled_departure": {"$toDate": "$$flight.scheduled_departure"}
+                    }]}
+                }}
+            }]}
+        }}
+    }}
+]
+
+# Документы без заранее вычисленных частей даты
+DATE_PARTS_FILTER = {
+    "booking_year": {"$exists": False},
+    "booking_date": {"$type": "date"}
 }
 
-def convert_dates_in_collection():
-    """Обновление документов: преобразование строк в даты"""
+# Год, месяц (UTC, как и $year/$month) и число билетов - поля индекса помесячной аналитики
+DATE_PARTS_PIPELINE = [
+    {"$set": {
+        "booking_year": {"$year": "$booking_date"},
+        "booking_month": {"$month": "$booking_date"},
+        "ticket_count": {"$size": {"$ifNull": ["$tickets", []]}}
+    }}
+]
+
+# Тот же индекс, что booking_month_stats в BOOKING_INDEXES (mongodb-second.py)
+DATE_PARTS_INDEX_NAME = "booking_month_stats"
+DATE_PARTS_INDEX = [("booking_year", ASCENDING), ("booking_month", ASCENDING),
+                    ("ticket_count", ASCENDING), ("total_amount", ASCENDING)]
+
+# Коды ошибок превышения лимита памяти стадии ($sort/$group) без allowDiskUse
+MEMORY_LIMIT_CODES = {292, 16819, 16945}
+
+def id_ranges(collection, chunk_size=CHUNK_SIZE):
+    """Границы диапазонов _id по chunk_size документов.
+
+    Клиент получает только граничные _id (выборка по индексу _id),
+    сами документы не читаются.
+    """
+    lower = None
+    while True:
+        query = {"_id": {"$gt": lower}} if lower is not None else {}
+        boundary = list(
+            collection.find(query, {"_id": 1}).sort("_id", 1).skip(chunk_size - 1).limit(1)
+        )
+        if not boundary:
+            yield lower, None
+            return
+        upper = boundary[0]["_id"]
+        yield lower, upper
+        lower = upper
+
+def update_in_chunks(collection, query, pipeline, chunk_size=CHUNK_SIZE):
+    """update_many с конвейером по диапазонам _id; возвращает число изменённых документов"""
+    updated = 0
+    for lower, upper in id_ranges(collection, chunk_size):
+        id_range = {}
+        if lower is not None:
+            id_range["$gt"] = lower
+        if upper is not None:
+            id_range["$lte"] = upper
+        chunk_query = dict(query, _id=id_range) if id_range else query
+
+        result = collection.update_many(chunk_query, pipeline)
+        updated += result.modified_count
+    return updated
+
+def convert_dates_in_collection(chunk_size=CHUNK_SIZE):
+    """Обновление документов: преобразование строк в даты на стороне сервера"""
     try:
-        client = MongoClient(**MONGO_CONFIG)
+        client = get_mongo()
         db = client.airline_database
         bookings = db.bookings
-        
-        # Находим документы с датами в виде строк
-        docs_with_string_dates = bookings.find({
-            "booking_date": {"$type": "string"}
-        })
-
-        bulk_operations = []
-        for doc in docs_with_string_dates:
-            try:
-                new_date = datetime.fromisoformat(doc['booking_date'])
-                bulk_operations.append(
-                    UpdateMany(
-                        {"_id": doc['_id']},
-                        {"$set": {"booking_date": new_date}}
-                    )
-                )
-            except Exception as e:
-                print(f"Ошибка в документе {doc['_id']}: {str(e)}")
-
-        if bulk_operations:
-            bookings.bulk_write(bulk_operations)
-            print(f"Обновлено {len(bulk_operations)} документов")
-
-        client.close()
+
+        updated = update_in_chunks(bookings, STRING_DATES_FILTER, CONVERT_DATES_PIPELINE, chunk_size)
+        print(f"Обновлено {updated} документов")
     except Exception as e:
         print(f"Ошибка подключения: {str(e)}")
 
-def run_aggregation():
-    """Выполнение агрегации с преобразованием дат"""
+def backfill_date_parts(chunk_size=CHUNK_SIZE):
+    """Заполнение booking_year/booking_month/ticket_count и индекса для уже загруженных данных"""
+    try:
+        bookings = get_mongo().airline_database.bookings
+        updated = update_in_chunks(bookings, DATE_PARTS_FILTER, DATE_PARTS_PIPELINE, chunk_size)
+        bookings.create_index(DATE_PARTS_INDEX, name=DATE_PARTS_INDEX_NAME)
+        print(f"Части дат заполнены в {updated} документах")
+    except Exception as e:
+        print(f"Ошибка заполнения частей дат: {str(e)}")
+
+def aggregate_with_fallback(collection, pipeline, read_mode="dict", batch_size=None):
+    """Агрегация в памяти; при превышении лимита стадии - повтор с allowDiskUse.
+
+    Сначала запрос идёт без allowDiskUse: если план опирается на индекс,
+    лимит не достигается, а сброс на диск лишь маскировал бы отсутствие индекса.
+    """
     try:
-        client = MongoClient(**MONGO_CONFIG)
+        return list(mongo_read.aggregate(collection, pipeline, read_mode, batch_size,
+                                         allowDiskUse=False))
+    except OperationFailure as e:
+        if e.code not in MEMORY_LIMIT_CODES:
+            raise
+        print(f"Превышен лимит памяти стадии ({e.code}), повтор с allowDiskUse")
+        return list(mongo_read.aggregate(collection, pipeline, read_mode, batch_size,
+                                         allowDiskUse=True))
+
+def monthly_stats(start, end, min_tickets=1, read_mode="dict", batch_size=None):
+    """Помесячные бронирования, билеты и средняя цена билета за [start, end].
+
+    start и end - пары (год, месяц). Отбор по году и числу билетов идёт
+    по границам индекса booking_month_stats, все нужные поля есть в
+    индексе, поэтому документы не читаются; $group держит в памяти
+    только по строке на месяц.
+    """
+    start_key = start[0] * 100 + start[1]
+    end_key = end[0] * 100 + end[1]
+    month_key = {"$add": [{"$multiply": ["$_id.year", 100]}, "$_id.month"]}
+    pipeline = [
+        {"$match": {
+            "booking_year": {"$gte": start[0], "$lte": end[0]},
+            "ticket_count": {"$gte": min_tickets}
+        }},
+        {"$project": {"_id": 0, "booking_year": 1, "booking_month": 1,
+                      "ticket_count": 1, "total_amount": 1}},
+        {"$group": {
+            "_id": {"year": "$booking_year", "month": "$booking_month"},
+            "bookings": {"$sum": 1},
+            "tickets": {"$sum": "$ticket_count"},
+            "revenue": {"$sum": "$total_amount"}
+        }},
+        # Крайние годы отсекаются по месяцу уже после группировки - это десятки строк
+        {"$match": {"$expr": {"$and": [{"$gte": [month_key, start_key]},
+                                       {"$lte": [month_key, end_key]}]}}},
+        {"$set": {"avg_price": {"$cond": [{"$gt": ["$tickets", 0]},
+                                          {"$divide": ["$revenue", "$tickets"]}, None]}}},
+        {"$sort": {"_id.year": 1, "_id.month": 1}}
+    ]
+    bookings = get_mongo().airline_database.bookings
+    return aggregate_with_fallback(bookings, pipeline, read_mode, batch_size)
+
+def print_monthly_stats(rows):
+    print("\nПомесячная статистика:")
+    print("{:<6} {:<6} {:<10} {:<10} {:<12}".format(
+        "Год", "Месяц", "Брони", "Билеты", "Ср.Цена"
+    ))
+    for row in rows:
+        avg_price = row['avg_price'] or 0
+        print(f"{row['_id']['year']:<6} {row['_id']['month']:<6} {row['bookings']:<10} "
+              f"{row['tickets']:<10} {avg_price:<12.2f}")
+
+def parse_month(value):
+    """'2017-07' -> (2017, 7)"""
+    year, month = value.split("-")
+    return int(year), int(month)
+
+def run_aggregation(read_mode="dict", batch_size=None):
+    """Выполнение агрегации по датам бронирований.
+
+    Год, месяц и число билетов заранее записаны в документ, поэтому
+    $match и $sort идут по индексу booking_month_stats, а $limit
+    останавливает обход после первых документов.
+    """
+    try:
+        client = get_mongo()
         db = client.airline_database
-        
+
         pipeline = [
-            {
-                "$addFields": {
-                    "booking_date": {
-                        "$cond": {
-                            "if": {"$eq": [{"$type": "$booking_date"}, "string"]},
-                            "then": {"$dateFromString": {"dateString": "$booking_date"}},
-                            "else": "$booking_date"
-                        }
-                    }
-                }
-            },
+            {"$match": {"ticket_count": {"$gt": 1}}},
+            {"$sort": {"booking_year": 1, "booking_month": 1}},
+            {"$limit": 10},
             {
                 "$project": {
-                    "year": {"$year": "$booking_date"},
-                    "month": {"$month": "$booking_date"},
-                    "total_tickets": {"$size": "$tickets"},
-                    "avg_price": {
-                        "$divide": [
-                            "$total_amount",
-                            {"$cond": [
-                                {"$eq": [{"$size": "$tickets"}, 0]},
-                                1,
-                                {"$size": "$tickets"}
-                            ]}
-                        ]
-                    }
+                    "_id": 0,
+                    "year": "$booking_year",
+                    "month": "$booking_month",
+                    "total_tickets": "$ticket_count",
+                    "avg_price": {"$divide": ["$total_amount", "$ticket_count"]}
                 }
-            },
-            {"$match": {"total_tickets": {"$gt": 1}}},
-            {"$sort": {"year": 1, "month": 1}},
-            {"$limit": 10}
+            }
         ]
 
-        results = db.bookings.aggregate(pipeline)
-        
+        results = aggregate_with_fallback(db.bookings, pipeline, read_mode, batch_size)
+
         print("\nРезультаты агрегации:")
         print("{:<6} {:<6} {:<8} {:<12}".format(
             "Год", "Месяц", "Билеты", "Ср.Цена"
         ))
         for doc in results:
             print(f"{doc['year']:<6} {doc['month']:<6} {doc['total_tickets']:<8} {doc['avg_price']:<12.2f}")
-
-        client.close()
     except Exception as e:
         print(f"Ошибка агрегации: {str(e)}")
 
 if __name__ == "__main__":
-    convert_dates_in_collection()
-    run_aggregation()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Преобразование дат и агрегация по бронированиям")
+    mongo_read.add_read_arguments(parser)
+    parser.add_argument("--backfill", action="store_true",
+                        help="преобразовать строковые даты и заполнить booking_year/"
+                             "booking_month/ticket_count в загруженных документах")
+    parser.add_argument("--monthly", nargs=2, metavar=("FROM", "TO"),
+                        help="помесячная статистика за период, месяцы в формате ГГГГ-ММ")
+    parser.add_argument("--min-tickets", type=int, default=1,
+                        help="с --monthly: учитывать бронирования не меньше чем с N билетами")
+    args = parser.parse_args()
+
+    if args.backfill:
+        convert_dates_in_collection()
+        backfill_date_parts()
+    if args.monthly:
+        try:
+            rows = monthly_stats(parse_month(args.monthly[0]), parse_month(args.monthly[1]),
+                                 args.min_tickets, args.read_mode, args.batch_size)
+            print_monthly_stats(rows)
+        except Exception as e:
+            print(f"Ошибка помесячной статистики: {str(e)}")
+    else:
+        run_aggregation(args.read_mode, args.batch_size)
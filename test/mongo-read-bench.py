@@ -0,0 +1,92 @@
+"""Микро-бенчмарк чтения bookings: документов/сек при разных настройках курсора.
+
+Два замера:
+  * полный цикл - запрос к mongod, получение пачек и обращение к
+    печатаемым полям (booking_ref, total_amount, имена пассажиров);
+  * только декодирование - те же байты, уже полученные с сервера,
+    разбираются bson.decode или лениво через RawBSONDocument.
+
+Запускать против локального mongod, иначе сеть скрывает разницу.
+"""
+import argparse
+import statistics
+import time
+import bson
+import pandas as pd
+from bson.raw_bson import RawBSONDocument
+from connections import get_mongo
+import mongo_read
+
+DOCS_LIMIT = 50000
+BATCH_SIZES = (None, 100, 1000, 5000)
+REPEATS = 3
+
+def touch_printed_fields(doc):
+    """Обращение к полям, которые печатают скрипты mongo-*"""
+    names = [ticket["passenger"] for ticket in doc["tickets"]]
+    return doc["booking_ref"], doc["total_amount"], names
+
+def bench_cursor(bookings, mode, batch_size, limit=DOCS_LIMIT, repeats=REPEATS):
+    """Полный цикл чтения: документов/сек (медиана по repeats)"""
+    rates = []
+    for _ in range(repeats):
+        count = 0
+        start_time = time.perf_counter()
+        for doc in mongo_read.find(bookings, {}, mode, batch_size).limit(limit):
+            touch_printed_fields(doc)
+            count += 1
+        elapsed = time.perf_counter() - start_time
+        rates.append(count / elapsed if elapsed else 0.0)
+    return statistics.median(rates)
+
+def bench_decode(raw_docs, repeats=REPEATS):
+    """Только разбор уже полученных байтов: полный bson.decode против ленивого"""
+    payloads = [doc.raw for doc in raw_docs]
+    decoders = {
+        "decode": bson.decode,
+        "raw_lazy": RawBSONDocument
+    }
+    results = {}
+    for name, decoder in decoders.items():
+        rates = []
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            for payload in payloads:
+                touch_printed_fields(decoder(payload))
+            elapsed = time.perf_counter() - start_time
+            rates.append(len(payloads) / elapsed if elapsed else 0.0)
+        results[name] = statistics.median(rates)
+    return results
+
+def main(limit=DOCS_LIMIT, batch_sizes=BATCH_SIZES, repeats=REPEATS):
+    bookings = get_mongo().airline_database.bookings
+
+    results = []
+    for mode in mongo_read.READ_MODES:
+        for batch_size in batch_sizes:
+            rate = bench_cursor(bookings, mode, batch_size, limit, repeats)
+            results.append({"mode": mode, "batch_size": batch_size or "default",
+                            "docs_per_sec": rate})
+            print(f"{mode}, batch {batch_size or 'default'}: {rate:.0f} док/сек")
+
+    raw_docs = list(mongo_read.find(bookings, {}, "raw").limit(limit))
+    size = sum(len(doc.raw) for doc in raw_docs)
+    decode = bench_decode(raw_docs, repeats)
+
+    print("\n=== Полный цикл чтения ===")
+    print(pd.DataFrame(results).to_string())
+    print(f"\n=== Только декодирование ({len(raw_docs)} док., "
+          f"{size / len(raw_docs) if raw_docs else 0:.0f} байт/док) ===")
+    for name, rate in decode.items():
+        print(f"{name}: {rate:.0f} док/сек")
+    return results, decode
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Скорость чтения bookings при разных настройках")
+    parser.add_argument("--limit", type=int, default=DOCS_LIMIT, help="документов в замере")
+    parser.add_argument("--batch-sizes", type=int, nargs="+",
+                        help="размеры пачек курсора (по умолчанию: default, 100, 1000, 5000)")
+    parser.add_argument("--repeats", type=int, default=REPEATS, help="повторов каждого замера")
+    args = parser.parse_args()
+
+    main(args.limit, tuple(args.batch_sizes) if args.batch_sizes else BATCH_SIZES, args.repeats)
@@ -1,89 +1,303 @@
-from pymongo import MongoClient
+import argparse
+import statistics
+import sys
+import time
+import unicodedata
 from pprint import pprint
-import re
-
-# Конфигурация подключения к MongoDB
-MONGO_CONFIG = {
-   "host": "192.168.50.24",
-    "port": 27017,
-    "username": "root",      # Добавляем имя пользователя
-    "password": "root",  # Добавляем пароль
-    "authSource": "admin",              # Указываем базу аутентификации
-    "authMechanism": "SCRAM-SHA-256"    # Механизм аутентификации
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import UpdateOne
+from connections import get_mongo
+import mongo_read
+
+def normalize_name(name):
+    """NFKC + casefold - та же нормализация, что у passenger_search в mongodb-second.py"""
+    return unicodedata.normalize("NFKC", name).casefold()
+
+def prefix_bounds(prefix):
+    """Префикс -> полуинтервал [lower, upper) в порядке кодовых точек.
+
+    Регистронезависимый $regex не использует границы индекса, а диапазон
+    по нормализованному полю - обычный IXSCAN.
+    """
+    lower = normalize_name(prefix)
+    if not lower:
+        raise ValueError("Пустой префикс")
+    return lower, lower[:-1] + chr(ord(lower[-1]) + 1)
+
+def passenger_prefix_filter(prefix):
+    lower, upper = prefix_bounds(prefix)
+    return {"tickets.passenger_search": {"$gte": lower, "$lt": upper}}
+
+def passenger_projection(lower, upper):
+    """Только совпавшие билеты и только имя пассажира"""
+    return [{"$project": {
+        "_id": 0,
+        "booking_ref": 1,
+        "tickets": {"$map": {
+            "input": {"$filter": {
+                "input": "$tickets",
+                "cond": {"$and": [
+                    {"$gte": ["$$this.passenger_search", lower]},
+                    {"$lt": ["$$this.passenger_search", upper]}
+                ]}
+            }},
+            "in": {"ticket_no": "$$this.ticket_no", "passenger": "$$this.passenger"}
+        }}
+    }}]
+
+# Фильтры запросов main(); по ним же проверяются планы в verify_indexes
+QUERIES = {
+    "exact_match": {"booking_ref": "00000F"},
+    "amount": {"total_amount": {"$gt": 200000}},
+    "flight": {
+        "tickets.flights": {
+            "$elemMatch": {
+                "flight_no": "PG0402",
+                "status": "Arrived"
+            }
+        }
+    },
+    "passenger_prefix": passenger_prefix_filter("Иван"),
+    "complex": {
+        "$and": [
+            {"total_amount": {"$gte": 100000, "$lte": 200000}},
+            {"tickets.flights.departure_airport": {"$in": ["SVO", "DME", "VKO"]}}
+        ]
+    }
+}
+QUERY_LIMITS = {"exact_match": 1, "amount": 3}
+
+# Все рейсы бронирования одним массивом (tickets.flights - массив массивов)
+ALL_FLIGHTS = {"$reduce": {
+    "input": "$tickets.flights",
+    "initialValue": [],
+    "in": {"$concatArrays": ["$$value", "$$this"]}
+}}
+
+# Серверные стадии после $match: клиенту уходят только нужные поля и
+# совпавшие вложенные элементы, а не бронирование целиком
+PROJECTIONS = {
+    "flight": [{"$project": {
+        "_id": 0,
+        "booking_ref": 1,
+        "flights": {"$map": {
+            "input": {"$filter": {"input": ALL_FLIGHTS,
+                                  "cond": {"$eq": ["$$this.flight_no", "PG0402"]}}},
+            "in": {"flight_no": "$$this.flight_no",
+                   "departure_airport": "$$this.departure_airport",
+                   "arrival_airport": "$$this.arrival_airport"}
+        }}
+    }}],
+    "passenger_prefix": passenger_projection(*prefix_bounds("Иван")),
+    "complex": [{"$project": {
+        "_id": 0,
+        "booking_ref": 1,
+        "total_amount": 1,
+        "departure_airports": {"$reduce": {
+            "input": "$tickets.flights.departure_airport",
+            "initialValue": [],
+            "in": {"$setUnion": ["$$value", "$$this"]}
+        }}
+    }}]
 }
+TRANSFER_REPEATS = 5
+# Во сколько раз просмотренных документов может быть больше возвращённых
+MAX_EXAMINED_RATIO = 10
+# Документов в одном bulk_write при заполнении passenger_search
+BACKFILL_BATCH = 1000
+
+def search_passengers(collection, prefix, limit=None, read_mode="dict", batch_size=None):
+    """Бронирования с пассажирами на prefix - только совпавшие билеты.
+
+    Документы отбираются по индексу tickets.passenger_search, лишние билеты
+    отбрасывает $filter на сервере.
+    """
+    lower, upper = prefix_bounds(prefix)
+    pipeline = [
+        {"$match": {"tickets.passenger_search": {"$gte": lower, "$lt": upper}}},
+        *passenger_projection(lower, upper)
+    ]
+    if limit:
+        pipeline.insert(1, {"$limit": limit})
+    return list(mongo_read.aggregate(collection, pipeline, read_mode, batch_size))
 
-def main():
-    # Подключение к MongoDB
-    client = MongoClient(**MONGO_CONFIG)
+def backfill_passenger_search(collection, batch_size=BACKFILL_BATCH):
+    """Заполнение tickets.passenger_search в уже загруженных документах"""
+    updated = 0
+    requests = []
+    cursor = collection.find(
+        {"tickets": {"$elemMatch": {"passenger_search": {"$exists": False}}}},
+        {"tickets.passenger": 1}
+    )
+    for doc in cursor:
+        names = [normalize_name(ticket["passenger"]) for ticket in doc["tickets"]]
+        requests.append(UpdateOne(
+            {"_id": doc["_id"]},
+            {"$set": {f"tickets.{i}.passenger_search": name for i, name in enumerate(names)}}
+        ))
+        if len(requests) >= batch_size:
+            updated += collection.bulk_write(requests, ordered=False).modified_count
+            requests = []
+    if requests:
+        updated += collection.bulk_write(requests, ordered=False).modified_count
+    print(f"Обновлено документов: {updated}")
+    return updated
+
+def projected(collection, name, read_mode="dict", batch_size=None):
+    """Запрос QUERIES[name] с серверной проекцией PROJECTIONS[name]"""
+    return mongo_read.aggregate(collection, [{"$match": QUERIES[name]}, *PROJECTIONS[name]],
+                                read_mode, batch_size)
+
+def measure_transfer(cursor_factory, repeats=TRANSFER_REPEATS):
+    """Медиана времени чтения всех документов и объём полученного BSON"""
+    times = []
+    size = count = 0
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        docs = list(cursor_factory())
+        times.append(time.perf_counter() - start_time)
+        size = sum(len(doc.raw) for doc in docs)
+        count = len(docs)
+    return {"docs": count, "bytes": size, "ms": statistics.median(times) * 1000}
+
+def compare_transfer(collection, repeats=TRANSFER_REPEATS):
+    """Полные документы против серверной проекции: байты и задержка по каждому запросу"""
+    raw = collection.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+    results = []
+    for name in PROJECTIONS:
+        full = measure_transfer(lambda: raw.find(QUERIES[name]), repeats)
+        slim = measure_transfer(lambda: projected(raw, name), repeats)
+        results.append({"query": name, "full": full, "projected": slim})
+        if not full['docs']:
+            print(f"{name}: документов не найдено")
+            continue
+        print(f"{name}: {full['docs']} док., "
+              f"полные {full['bytes'] / 1024:.1f} КБ за {full['ms']:.1f} мс, "
+              f"проекция {slim['bytes'] / 1024:.1f} КБ за {slim['ms']:.1f} мс "
+              f"({slim['bytes'] / full['bytes']:.0%} байт)")
+    return results
+
+def plan_stages(plan):
+    """Все стадии плана explain сверху вниз"""
+    yield plan["stage"]
+    if "inputStage" in plan:
+        yield from plan_stages(plan["inputStage"])
+    for child in plan.get("inputStages", []):
+        yield from plan_stages(child)
+
+def explain_query(collection, name):
+    cursor = collection.find(QUERIES[name])
+    if name in QUERY_LIMITS:
+        cursor = cursor.limit(QUERY_LIMITS[name])
+    explain = cursor.explain()
+    winning = explain["queryPlanner"]["winningPlan"]
+    stats = explain["executionStats"]
+    return {
+        "query": name,
+        "stages": list(plan_stages(winning.get("queryPlan", winning))),
+        "returned": stats["nReturned"],
+        "keys_examined": stats["totalKeysExamined"],
+        "docs_examined": stats["totalDocsExamined"]
+    }
+
+def verify_indexes(collection, max_ratio=MAX_EXAMINED_RATIO):
+    """Проверка планов запросов: без COLLSCAN и без лишних просмотренных документов"""
+    failures = []
+    for name in QUERIES:
+        result = explain_query(collection, name)
+        problems = []
+        if "COLLSCAN" in result["stages"]:
+            problems.append("COLLSCAN")
+        if result["docs_examined"] > max(result["returned"], 1) * max_ratio:
+            problems.append(f"просмотрено {result['docs_examined']} документов "
+                            f"на {result['returned']} возвращённых")
+        status = "ОШИБКА: " + "; ".join(problems) if problems else "ok"
+        print(f"{name}: {' -> '.join(reversed(result['stages']))}, "
+              f"ключей {result['keys_examined']}, документов {result['docs_examined']}, "
+              f"возвращено {result['returned']} - {status}")
+        if problems:
+            failures.append(name)
+    return failures
+
+def main(read_mode="dict", batch_size=None):
+    # Общий клиент MongoDB
+    client = get_mongo()
     db = client.airline_database
     bookings = db.bookings
 
     try:
         # 1. Запрос на точное совпадение (основной документ)
         print("1. Бронирование с конкретным референсом:")
-        exact_match = bookings.find_one({"booking_ref": "00000F"})
-        pprint(exact_match)
+        exact_match = next(mongo_read.find(bookings, QUERIES["exact_match"], read_mode).limit(1),
+                           None)
+        pprint(mongo_read.to_dict(exact_match))
 
         # 2. Запрос с оператором сравнения $gt (основной документ)
         print("\n2. Бронирования с суммой > 200000 руб:")
-        amount_query = bookings.find({
-            "total_amount": {"$gt": 200000}
-        }).limit(3)
+        amount_query = mongo_read.find(bookings, QUERIES["amount"], read_mode).limit(
+            QUERY_LIMITS["amount"]
+        )
         for doc in amount_query:
             print(f"Реф: {doc['booking_ref']}, Сумма: {doc['total_amount']}")
 
         # 3. Запрос по вложенному документу с $elemMatch
         print("\n3. Бронирования с рейсом PG0402:")
-        flight_query = bookings.find({
-            "tickets.flights": {
-                "$elemMatch": {
-                    "flight_no": "PG0402",
-                    "status": "Arrived"
-                }
-            }
-        })
-        for doc in flight_query:
+        for doc in projected(bookings, "flight", read_mode, batch_size):
             print(f"Реф: {doc['booking_ref']}")
             print("Рейсы:")
-            for ticket in doc['tickets']:
-                for flight in ticket['flights']:
-                    if flight['flight_no'] == 'PG0402':
-                        print(f"- {flight['flight_no']} {flight['departure_airport']}-{flight['arrival_airport']}")
+            for flight in doc['flights']:
+                print(f"- {flight['flight_no']} {flight['departure_airport']}-{flight['arrival_airport']}")
 
-        # 4. Запрос с регулярным выражением (вложенный документ)
+        # 4. Поиск по началу имени пассажира (вложенный документ)
         print("\n4. Бронирования с именами пассажиров на 'Иван':")
-        regex_query = bookings.find({
-            "tickets.passenger": {
-                "$regex": r"^Иван",
-                "$options": "i"
-            }
-        })
-        for doc in regex_query:
+        for doc in search_passengers(bookings, "Иван", read_mode=read_mode,
+                                     batch_size=batch_size):
             print(f"\nРеф: {doc['booking_ref']}")
             print("Пассажиры:")
             for ticket in doc['tickets']:
-                if re.search(r'^Иван', ticket['passenger'], re.IGNORECASE):
-                    print(f"- {ticket['passenger']}")
+                print(f"- {ticket['passenger']}")
 
         # 5. Дополнительный запрос с комбинацией условий
         print("\n5. Бронирования с суммой 100000-200000 руб и московскими аэропортами:")
-        complex_query = bookings.find({
-            "$and": [
-                {"total_amount": {"$gte": 100000, "$lte": 200000}},
-                {"tickets.flights.departure_airport": {"$in": ["SVO", "DME", "VKO"]}}
-            ]
-        })
-        for doc in complex_query:
+        for doc in projected(bookings, "complex", read_mode, batch_size):
             print(f"\nРеф: {doc['booking_ref']}")
             print(f"Сумма: {doc['total_amount']}")
             print("Аэропорты вылета:")
-            airports = {f['departure_airport'] for t in doc['tickets'] for f in t['flights']}
-            print(", ".join(airports))
+            print(", ".join(doc['departure_airports']))
 
     except Exception as e:
         print(f"Ошибка: {str(e)}")
-    finally:
-        client.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Запросы к коллекции bookings")
+    parser.add_argument("--verify-indexes", action="store_true",
+                        help="проверить планы запросов через explain() вместо их выполнения")
+    parser.add_argument("--search", metavar="PREFIX",
+                        help="найти пассажиров по началу имени без учёта регистра")
+    parser.add_argument("--backfill-search", action="store_true",
+                        help="заполнить tickets.passenger_search в загруженных документах")
+    parser.add_argument("--compare-transfer", action="store_true",
+                        help="сравнить объём и время чтения полных документов и проекций")
+    mongo_read.add_read_arguments(parser)
+    parser.add_argument("--max-ratio", type=float, default=MAX_EXAMINED_RATIO,
+                        help="допустимое отношение просмотренных документов к возвращённым")
+    args = parser.parse_args()
+
+    bookings = get_mongo().airline_database.bookings
+    if args.backfill_search:
+        backfill_passenger_search(bookings)
+    if args.search:
+        for doc in search_passengers(bookings, args.search, read_mode=args.read_mode,
+                                     batch_size=args.batch_size):
+            names = ", ".join(ticket['passenger'] for ticket in doc['tickets'])
+            print(f"{doc['booking_ref']}: {names}")
+    elif args.compare_transfer:
+        compare_transfer(bookings)
+    elif args.verify_indexes:
+        failures = verify_indexes(bookings, args.max_ratio)
+        if failures:
+            print(f"Планы без подходящего индекса: {', '.join(failures)}")
+            sys.exit(1)
+    elif not args.backfill_search:
+        main(args.read_mode, args.batch_size)
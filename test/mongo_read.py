@@ -0,0 +1,47 @@
+"""Настройки чтения больших выборок из MongoDB.
+
+По умолчанию PyMongo сразу раскладывает каждый документ в дерево dict/list.
+Для широких вложенных бронирований это основная статья CPU на клиенте.
+В режиме raw документы приходят как RawBSONDocument: байты разбираются
+лениво, при обращении к полю, а вложенные документы остаются сырыми до
+обращения к ним - декодируется только то, что печатается.
+"""
+import bson
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+READ_MODES = ("dict", "raw")
+# Документов в одном getMore; None - размер пачки по умолчанию сервера
+DEFAULT_BATCH_SIZE = None
+
+RAW_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+def with_read_mode(collection, mode="dict"):
+    """Коллекция с нужным классом документов"""
+    if mode == "raw":
+        return collection.with_options(codec_options=RAW_OPTIONS)
+    return collection
+
+def find(collection, query, mode="dict", batch_size=DEFAULT_BATCH_SIZE, **kwargs):
+    cursor = with_read_mode(collection, mode).find(query, **kwargs)
+    if batch_size:
+        cursor = cursor.batch_size(batch_size)
+    return cursor
+
+def aggregate(collection, pipeline, mode="dict", batch_size=DEFAULT_BATCH_SIZE, **kwargs):
+    if batch_size:
+        kwargs["batchSize"] = batch_size
+    return with_read_mode(collection, mode).aggregate(pipeline, **kwargs)
+
+def to_dict(doc):
+    """Полное декодирование документа (для pprint и т.п.)"""
+    if isinstance(doc, RawBSONDocument):
+        return bson.decode(doc.raw)
+    return doc
+
+def add_read_arguments(parser):
+    """Общие параметры чтения для argparse скриптов"""
+    parser.add_argument("--read-mode", choices=READ_MODES, default="dict",
+                        help="dict - обычные словари, raw - ленивый RawBSONDocument")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="документов в одной пачке курсора")
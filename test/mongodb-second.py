@@ -1,138 +1,490 @@
-import psycopg2
-from pymongo import MongoClient
-from datetime import datetime
-
-# Конфигурации подключений
-POSTGRES_CONFIG = {
-    "host": "192.168.50.24",
-    "database": "demo",
-    "user": "postgres",
-    "password": "postgres"
-}
-
-MONGO_CONFIG = {
-    "host": "192.168.50.24",
-    "port": 27017,
-    "username": "root",      # Добавляем имя пользователя
-    "password": "root",  # Добавляем пароль
-    "authSource": "admin",              # Указываем базу аутентификации
-    "authMechanism": "SCRAM-SHA-256"    # Механизм аутентификации
-}
-
-def create_nested_documents(pg_cursor):
-    """Создание вложенных документов (бронирование -> билеты -> рейсы)"""
-    pg_cursor.execute("""
-        SELECT 
-            b.book_ref,
-            b.book_date,
-            b.total_amount,
-            jsonb_agg(
-                jsonb_build_object(
-                    'ticket_no', t.ticket_no,
-                    'passenger', t.passenger_name,
-                    'flights', tf.flight_data
+import argparse
+import queue
+import resource
+import sys
+import threading
+import time
+import unicodedata
+from pymongo import ASCENDING, IndexModel, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+from pymongo.write_concern import WriteConcern
+from datetime import datetime, timezone
+from connections import acquire_pg, get_mongo, release_pg
+
+# Строк за одну выборку серверного курсора
+ITERSIZE = 2000
+# Документов в одном insert_many и пачек в очереди к потоку записи
+BATCH_SIZE = 1000
+QUEUE_SIZE = 4
+# Рейсов в одном документе airport_buckets (шаблон bucket)
+BUCKET_SIZE = 200
+AIRPORTS_LAYOUTS = ("array", "buckets", "both")
+
+# Индексы коллекции bookings (создаются после загрузки, см. ensure_indexes).
+# Составные индексы по tickets.flights.* - multikey; равенство перед
+# диапазоном (ESR), чтобы $in по аэропорту и диапазон суммы шли по границам индекса.
+BOOKING_INDEXES = [
+    {"name": "booking_ref_unique", "keys": [("booking_ref", ASCENDING)], "unique": True},
+    {"name": "total_amount", "keys": [("total_amount", ASCENDING)]},
+    {"name": "flight_no_status", "keys": [("tickets.flights.flight_no", ASCENDING),
+                                          ("tickets.flights.status", ASCENDING)]},
+    {"name": "passenger_search", "keys": [("tickets.passenger_search", ASCENDING)]},
+    {"name": "departure_airport_amount", "keys": [("tickets.flights.departure_airport", ASCENDING),
+                                                  ("total_amount", ASCENDING)]},
+    # Помесячная аналитика: сортировка по году и месяцу идёт по индексу,
+    # а с ticket_count и total_amount запрос покрывается индексом целиком
+    {"name": "booking_month_stats", "keys": [("booking_year", ASCENDING),
+                                             ("booking_month", ASCENDING),
+                                             ("ticket_count", ASCENDING),
+                                             ("total_amount", ASCENDING)]},
+]
+
+# Ключи upsert коллекций аэропортов: повторная миграция обновляет документы
+# на месте, а не дописывает копии
+AIRPORT_KEYS = ("airport_code",)
+AIRPORT_BUCKET_KEYS = ("airport_code", "month", "seq")
+
+# Индексы коллекций аэропортов создаются до загрузки: по ним ищет upsert.
+# updated_at - водяной знак инкрементального aircraft_model_stats (mongo-five.py)
+AIRPORT_INDEXES = [
+    {"name": "airport_code_unique", "keys": [("airport_code", ASCENDING)], "unique": True},
+    {"name": "updated_at", "keys": [("updated_at", ASCENDING)]},
+]
+
+AIRPORT_BUCKET_INDEXES = [
+    {"name": "airport_month_seq", "keys": [("airport_code", ASCENDING), ("month", ASCENDING),
+                                           ("seq", ASCENDING)], "unique": True},
+    {"name": "updated_at", "keys": [("updated_at", ASCENDING)]},
+]
+
+def create_nested_documents(pg_conn, itersize=ITERSIZE):
+    """Создание вложенных документов (бронирование -> билеты -> рейсы).
+
+    Строки читаются именованным (серверным) курсором порциями по itersize,
+    документы отдаются генератором - в памяти не больше одной порции.
+    """
+    with pg_conn.cursor(name="nested_documents") as pg_cursor:
+        pg_cursor.itersize = itersize
+        pg_cursor.execute("""
+            SELECT 
+                b.book_ref,
+                b.book_date,
+                b.total_amount,
+                jsonb_agg(
+                    jsonb_build_object(
+                        'ticket_no', t.ticket_no,
+                        'passenger', t.passenger_name,
+                        'flights', tf.flight_data
+                    )
+                ) AS tickets
+            FROM bookings b
+            JOIN tickets t ON b.book_ref = t.book_ref
+            JOIN (
+                SELECT 
+                    tf.ticket_no,
+                    jsonb_agg(
+                        jsonb_build_object(
+                            'flight_no', f.flight_no,
+                            'departure_airport', f.departure_airport,
+                            'arrival_airport', f.arrival_airport,
+                            'scheduled_departure', f.scheduled_departure,
+                            'status', f.status
+                        )
+                    ) AS flight_data
+                FROM ticket_flights tf
+                JOIN flights f ON tf.flight_id = f.flight_id
+                GROUP BY tf.ticket_no
+            ) tf ON t.ticket_no = tf.ticket_no
+            GROUP BY b.book_ref
+        """)
+        for item in pg_cursor:
+            booking_date = convert_date(item[1])
+            year, month = date_parts(booking_date)
+            yield {
+                "booking_ref": item[0],
+                "booking_date": booking_date,
+                "total_amount": float(item[2]),
+                # Заранее вычисленные поля для индекса booking_month_stats
+                "booking_year": year,
+                "booking_month": month,
+                "ticket_count": len(item[3]),
+                "tickets": add_passenger_search(
+                    convert_nested_dates(item[3], "flights", "scheduled_departure")
                 )
-            ) AS tickets
-        FROM bookings b
-        JOIN tickets t ON b.book_ref = t.book_ref
-        JOIN (
+            }
+
+def create_array_collection(pg_conn, itersize=ITERSIZE):
+    """Создание коллекции с массивами значений (аэропорты -> рейсы)"""
+    with pg_conn.cursor(name="array_collection") as pg_cursor:
+        pg_cursor.itersize = itersize
+        pg_cursor.execute("""
             SELECT 
-                tf.ticket_no,
+                a.airport_code,
+                a.airport_name,
                 jsonb_agg(
                     jsonb_build_object(
                         'flight_no', f.flight_no,
-                        'departure_airport', f.departure_airport,
+                        'departure_time', f.scheduled_departure,
                         'arrival_airport', f.arrival_airport,
-                        'scheduled_departure', f.scheduled_departure,
-                        'status', f.status
+                        'aircraft', ac.model
                     )
-                ) AS flight_data
-            FROM ticket_flights tf
-            JOIN flights f ON tf.flight_id = f.flight_id
-            GROUP BY tf.ticket_no
-        ) tf ON t.ticket_no = tf.ticket_no
-        GROUP BY b.book_ref
-        LIMIT 1000
-    """)
-    return pg_cursor.fetchall()
-
-def create_array_collection(pg_cursor):
-    """Создание коллекции с массивами значений (аэропорты -> рейсы)"""
-    pg_cursor.execute("""
-        SELECT 
-            a.airport_code,
-            a.airport_name,
-            jsonb_agg(
-                jsonb_build_object(
-                    'flight_no', f.flight_no,
-                    'departure_time', f.scheduled_departure,
-                    'arrival_airport', f.arrival_airport,
-                    'aircraft', ac.model
-                )
-            ) AS flights
-        FROM airports a
-        JOIN flights f ON a.airport_code = f.departure_airport
-        JOIN aircrafts ac ON f.aircraft_code = ac.aircraft_code
-        GROUP BY a.airport_code, a.airport_name
-    """)
-    return pg_cursor.fetchall()
+                ) AS flights
+            FROM airports a
+            JOIN flights f ON a.airport_code = f.departure_airport
+            JOIN aircrafts ac ON f.aircraft_code = ac.aircraft_code
+            GROUP BY a.airport_code, a.airport_name
+        """)
+        for item in pg_cursor:
+            yield {
+                "airport_code": item[0],
+                "airport_name": item[1],
+                "flights": [
+                    dict(flight, departure_time=convert_date(flight['departure_time']))
+                    for flight in item[2]
+                ]
+                # updated_at ставит сервер при upsert (см. upsert_request)
+            }
+
+def create_airport_buckets(pg_conn, itersize=ITERSIZE, bucket_size=BUCKET_SIZE):
+    """Аэропорты по шаблону bucket: документ на аэропорт, месяц и до bucket_size рейсов.
+
+    В отличие от create_array_collection массив рейсов ограничен, а
+    счётчики по моделям самолётов посчитаны заранее - агрегации не нужно
+    разворачивать каждый рейс.
+    """
+    with pg_conn.cursor(name="airport_buckets") as pg_cursor:
+        pg_cursor.itersize = itersize
+        pg_cursor.execute("""
+            SELECT 
+                a.airport_code,
+                a.airport_name,
+                date_trunc('month', f.scheduled_departure) AS month,
+                jsonb_agg(
+                    jsonb_build_object(
+                        'flight_no', f.flight_no,
+                        'departure_time', f.scheduled_departure,
+                        'arrival_airport', f.arrival_airport,
+                        'aircraft', ac.model
+                    )
+                    ORDER BY f.scheduled_departure
+                ) AS flights
+            FROM airports a
+            JOIN flights f ON a.airport_code = f.departure_airport
+            JOIN aircrafts ac ON f.aircraft_code = ac.aircraft_code
+            GROUP BY a.airport_code, a.airport_name, date_trunc('month', f.scheduled_departure)
+        """)
+        for airport_code, airport_name, month, flights in pg_cursor:
+            for seq, start in enumerate(range(0, len(flights), bucket_size)):
+                bucket = [
+                    dict(flight, departure_time=convert_date(flight['departure_time']))
+                    for flight in flights[start:start + bucket_size]
+                ]
+                yield {
+                    "airport_code": airport_code,
+                    "airport_name": airport_name,
+                    "month": month,
+                    "seq": seq,
+                    "count": len(bucket),
+                    "first_departure": bucket[0]["departure_time"],
+                    "last_departure": bucket[-1]["departure_time"],
+                    "models": model_counters(bucket),
+                    "flights": bucket
+                }
+
+def model_counters(flights):
+    """Счётчики рейсов по моделям самолётов и последний рейс каждой модели"""
+    models = {}
+    for flight in flights:
+        counter = models.setdefault(flight["aircraft"], {
+            "model": flight["aircraft"], "flights": 0, "last_departure": None, "last_flight": None
+        })
+        counter["flights"] += 1
+        if counter["last_departure"] is None or flight["departure_time"] >= counter["last_departure"]:
+            counter["last_departure"] = flight["departure_time"]
+            counter["last_flight"] = flight["flight_no"]
+    return list(models.values())
 
 def convert_date(obj):
-    """Конвертация datetime в строку для MongoDB"""
-    if isinstance(obj, datetime):
-        return obj.isoformat()
+    """Приведение даты к datetime - в MongoDB она попадёт как BSON Date.
+
+    Даты внутри jsonb приходят из PostgreSQL строками ISO 8601.
+    """
+    if isinstance(obj, str):
+        return datetime.fromisoformat(obj)
     return obj
 
-def main():
-    pg_conn = psycopg2.connect(**POSTGRES_CONFIG)
-    pg_cursor = pg_conn.cursor()
-    
-    # Подключение к MongoDB с аутентификацией
-    mongo_client = MongoClient(
-        host=MONGO_CONFIG["host"],
-        port=MONGO_CONFIG["port"],
-        username=MONGO_CONFIG["username"],
-        password=MONGO_CONFIG["password"],
-        authSource=MONGO_CONFIG["authSource"],
-        authMechanism=MONGO_CONFIG["authMechanism"]
+def date_parts(value):
+    """Год и месяц даты в UTC - так же их считают $year/$month в MongoDB"""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return value.year, value.month
+
+def convert_nested_dates(tickets, array_field, date_field):
+    """Приведение дат во вложенных массивах билетов (tickets.flights.scheduled_departure)"""
+    for ticket in tickets:
+        for item in ticket[array_field]:
+            item[date_field] = convert_date(item[date_field])
+    return tickets
+
+def normalize_name(name):
+    """Имя для поиска по префиксу: NFKC + casefold (та же функция в mongo-third.py)"""
+    return unicodedata.normalize("NFKC", name).casefold()
+
+def add_passenger_search(tickets):
+    """Нормализованное имя пассажира рядом с исходным - для индексного поиска"""
+    for ticket in tickets:
+        ticket["passenger_search"] = normalize_name(ticket["passenger"])
+    return tickets
+
+def upsert_request(doc, keys):
+    """Замена документа по ключу keys с upsert; updated_at - время сервера.
+
+    $$NOW вычисляется в момент записи, а не при построении документа:
+    документ, простоявший в очереди во время обновления статистики, не
+    окажется ниже её водяного знака.
+    """
+    return UpdateOne(
+        {key: doc[key] for key in keys},
+        [{"$replaceWith": {"$literal": doc}}, {"$set": {"updated_at": "$$NOW"}}],
+        upsert=True
     )
+
+def drop_duplicates(collection, keys):
+    """Удаление копий документов с одинаковым ключом (от прежних запусков через insert_many).
+
+    Оставляется один документ на ключ - upsert всё равно перезапишет его содержимое.
+    """
+    duplicates = collection.aggregate([
+        {"$group": {"_id": {key: f"${key}" for key in keys},
+                    "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True)
+    removed = 0
+    for group in duplicates:
+        removed += collection.delete_many({"_id": {"$in": group["ids"][1:]}}).deleted_count
+    if removed:
+        print(f"{collection.name}: удалено дубликатов {removed}")
+    return removed
+
+def drop_stale(collection, since):
+    """Удаление документов, не перезаписанных этим запуском (updated_at < since).
+
+    Например, лишних корзин месяца, в котором рейсов стало меньше. Если у
+    аэропорта остались другие документы, их свежий updated_at заставит
+    mongo-five.py пересчитать аэропорт; исчезнувший целиком аэропорт
+    уходит из статистики только при полном пересчёте (--full).
+    """
+    removed = collection.delete_many({"updated_at": {"$lt": since}}).deleted_count
+    if removed:
+        print(f"{collection.name}: удалено устаревших документов {removed}")
+    return removed
+
+def write_documents(collection, documents, batch_size=BATCH_SIZE, write_concern=None,
+                    queue_size=QUEUE_SIZE, upsert_keys=None):
+    """Пакетная запись документов в MongoDB в отдельном потоке.
+
+    Генератор documents (чтение из PostgreSQL) работает в текущем потоке,
+    insert_many(ordered=False) - в потоке записи. Между ними ограниченная
+    очередь пачек, поэтому чтение и запись идут одновременно, а память
+    ограничена queue_size пачками. С upsert_keys вместо вставки - bulk_write
+    из upsert_request по этим полям.
+    """
+    if write_concern is not None:
+        collection = collection.with_options(write_concern=write_concern)
+
+    batches = queue.Queue(maxsize=queue_size)
+    stats = {'inserted': 0, 'errors': 0, 'failure': None}
+
+    def writer():
+        while True:
+            batch = batches.get()
+            if batch is None:
+                break
+            if stats['failure']:
+                # Запись уже сломана - только освобождаем очередь
+                continue
+            try:
+                if upsert_keys:
+                    collection.bulk_write([upsert_request(doc, upsert_keys) for doc in batch],
+                                          ordered=False)
+                else:
+                    collection.insert_many(batch, ordered=False)
+                stats['inserted'] += len(batch)
+            except BulkWriteError as e:
+                stats['inserted'] += (e.details['nInserted'] + e.details['nUpserted']
+                                      + e.details['nMatched'])
+                stats['errors'] += len(e.details['writeErrors'])
+            except Exception as e:
+                stats['failure'] = e
+
+    thread = threading.Thread(target=writer, daemon=True)
+    start_time = time.perf_counter()
+    thread.start()
+    try:
+        batch = []
+        for doc in documents:
+            if stats['failure']:
+                # Писатель упал - дочитывать курсор PostgreSQL незачем
+                break
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                batches.put(batch)
+                batch = []
+        if batch and not stats['failure']:
+            batches.put(batch)
+    finally:
+        batches.put(None)
+        thread.join()
+
+    if stats['failure']:
+        raise stats['failure']
+    duration = time.perf_counter() - start_time
+    stats['rate'] = stats['inserted'] / duration if duration else 0.0
+    return stats
+
+def ensure_indexes(collection, specs):
+    """Идемпотентное применение описания индексов.
+
+    Отсутствующие индексы создаются, индекс с тем же именем, но другими
+    ключами или уникальностью пересоздаётся; индексы вне описания не трогаются.
+    Уникальные индексы строятся по одному: дубликаты в коллекции ломают
+    только их, а не всю пачку create_indexes. Если какой-то индекс не
+    построен, после попытки построить остальные выбрасывается RuntimeError.
+    """
+    existing = collection.index_information()
+    models = []
+    for spec in specs:
+        current = existing.get(spec["name"])
+        if current:
+            if (current["key"] == spec["keys"]
+                    and current.get("unique", False) == spec.get("unique", False)):
+                continue
+            collection.drop_index(spec["name"])
+        models.append(IndexModel(spec["keys"], name=spec["name"],
+                                 unique=spec.get("unique", False)))
+
+    groups = [[model] for model in models if model.document.get("unique")]
+    regular = [model for model in models if not model.document.get("unique")]
+    if regular:
+        groups.append(regular)
+    created, failed = [], []
+    for group in groups:
+        names = [model.document["name"] for model in group]
+        try:
+            collection.create_indexes(group)
+            created.extend(names)
+        except OperationFailure as e:
+            failed.append(f"{', '.join(names)}: {str(e)}")
+
+    print(f"Индексы {collection.name}: создано {len(created)}, "
+          f"без изменений {len(specs) - len(models)}, ошибок {len(failed)}")
+    if failed:
+        raise RuntimeError(f"не созданы индексы {collection.name} - " + "; ".join(failed))
+    return created
+
+def print_write_stats(name, stats):
+    print(f"{name}: записано {stats['inserted']}, ошибок {stats['errors']}, "
+          f"{stats['rate']:.0f} док/сек")
+
+def peak_rss_mb():
+    """Пиковый RSS процесса в МБ (ru_maxrss в Linux - в килобайтах)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def main(itersize=ITERSIZE, batch_size=BATCH_SIZE, write_concern=None,
+         airports_layout="both", bucket_size=BUCKET_SIZE):
+    """Миграция; False, если она или построение индексов не удались"""
+    pg_conn = acquire_pg()
+    
+    # Общий клиент MongoDB с аутентификацией
+    mongo_client = get_mongo()
     
     db = mongo_client.airline_database
     
     try:
         # 1. Коллекция с вложенными документами
-        nested_data = create_nested_documents(pg_cursor)
         bookings_collection = db.bookings
-        for item in nested_data:
-            doc = {
-                "booking_ref": item[0],
-                "booking_date": convert_date(item[1]),
-                "total_amount": float(item[2]),
-                "tickets": item[3]
-            }
-            bookings_collection.insert_one(doc)
+        bookings_stats = write_documents(
+            bookings_collection, create_nested_documents(pg_conn, itersize),
+            batch_size, write_concern
+        )
 
         # 2. Коллекция с массивами значений
-        array_data = create_array_collection(pg_cursor)
         airports_collection = db.airports
-        for item in array_data:
-            doc = {
-                "airport_code": item[0],
-                "airport_name": item[1],
-                "flights": item[2]
-            }
-            airports_collection.insert_one(doc)
-            
+        # Время сервера до upsert: всё, что не перезаписано после него, устарело
+        run_started = db.command("hello")["localTime"]
+        if airports_layout in ("array", "both"):
+            drop_duplicates(airports_collection, AIRPORT_KEYS)
+            ensure_indexes(airports_collection, AIRPORT_INDEXES)
+            airports_stats = write_documents(
+                airports_collection, create_array_collection(pg_conn, itersize),
+                batch_size, write_concern, upsert_keys=AIRPORT_KEYS
+            )
+            if not airports_stats['errors']:
+                # Иначе удалили бы документы, запись которых не удалась
+                drop_stale(airports_collection, run_started)
+
+        # 3. Те же рейсы по шаблону bucket
+        buckets_collection = db.airport_buckets
+        if airports_layout in ("buckets", "both"):
+            drop_duplicates(buckets_collection, AIRPORT_BUCKET_KEYS)
+            ensure_indexes(buckets_collection, AIRPORT_BUCKET_INDEXES)
+            buckets_stats = write_documents(
+                buckets_collection, create_airport_buckets(pg_conn, itersize, bucket_size),
+                batch_size, write_concern, upsert_keys=AIRPORT_BUCKET_KEYS
+            )
+            if not buckets_stats['errors']:
+                # Иначе удалили бы документы, запись которых не удалась
+                drop_stale(buckets_collection, run_started)
+
         print("Миграция данных завершена успешно!")
+        print_write_stats("bookings", bookings_stats)
         print(f"Документов в bookings: {bookings_collection.count_documents({})}")
-        print(f"Документов в airports: {airports_collection.count_documents({})}")
+        if airports_layout in ("array", "both"):
+            print_write_stats("airports", airports_stats)
+            print(f"Документов в airports: {airports_collection.count_documents({})}")
+        if airports_layout in ("buckets", "both"):
+            print_write_stats("airport_buckets", buckets_stats)
+            print(f"Документов в airport_buckets: {buckets_collection.count_documents({})}")
+
+        # Индексы строятся после загрузки: так быстрее, чем поддерживать их при вставке
+        # (индексы коллекций аэропортов уже созданы перед upsert)
+        indexes_ok = True
+        try:
+            ensure_indexes(bookings_collection, BOOKING_INDEXES)
+        except (OperationFailure, RuntimeError) as e:
+            # Например, дубликаты booking_ref от прежних запусков
+            print(f"Ошибка создания индексов: {str(e)}")
+            indexes_ok = False
+        print(f"Пиковый RSS: {peak_rss_mb():.1f} МБ")
+        return indexes_ok
 
     except Exception as e:
         print(f"Ошибка миграции: {str(e)}")
+        return False
     finally:
-        pg_cursor.close()
-        pg_conn.close()
-        mongo_client.close()
+        release_pg(pg_conn)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Миграция данных из PostgreSQL в MongoDB")
+    parser.add_argument("--itersize", type=int, default=ITERSIZE,
+                        help="строк за одну выборку серверного курсора")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help="документов в одном insert_many")
+    parser.add_argument("--w", default=None,
+                        help="write concern: число узлов или majority")
+    parser.add_argument("--journal", action="store_true",
+                        help="ждать записи в журнал (j=true)")
+    parser.add_argument("--airports-layout", choices=AIRPORTS_LAYOUTS, default="both",
+                        help="array - массив рейсов в аэропорту, buckets - airport_buckets")
+    parser.add_argument("--bucket-size", type=int, default=BUCKET_SIZE,
+                        help="рейсов в одном документе airport_buckets")
+    args = parser.parse_args()
+
+    write_concern = None
+    if args.w is not None or args.journal:
+        w = int(args.w) if args.w and args.w.isdigit() else args.w
+        write_concern = WriteConcern(w=w, j=args.journal or None)
+
+    if not main(itersize=args.itersize, batch_size=args.batch_size, write_concern=write_concern,
+                airports_layout=args.airports_layout, bucket_size=args.bucket_size):
+        sys.exit(1)
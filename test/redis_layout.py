@@ -0,0 +1,438 @@
+"""Компактное хранение бронирований, рейсов и билетов в Redis.
+
+Вместо отдельного хэша на запись (booking:<book_ref> и т.д.) записи
+раскладываются по шардам - хэшам <сущность>:shard:<n>, где поле - id
+записи, а значение - JSON-массив значений без имён полей. Число шардов
+подбирается так, чтобы каждый шард укладывался в hash-max-listpack-entries
+и хранился listpack'ом; hash-max-listpack-value при необходимости
+поднимается до записи (ensure_value_limit). Даты хранятся секундами
+эпохи (UTC), суммы - целыми копейками, contact_data - вложенным объектом.
+
+Модуль импортируется миграцией (fetch_records / shard_batches отдают те же
+словари, что и HGETALL исходных ключей) и запускается как утилита:
+
+    python redis_layout.py convert   # перенос ключей в шарды
+    python redis_layout.py report    # байт на запись до и после
+
+Keyspace-уведомления сообщают только имя изменённого шарда, но не поле,
+поэтому после конвертации записи меняются через write_records: вместе с
+HSET в поток CHANGES_STREAM пишется исходное имя ключа записи.
+"""
+import argparse
+import calendar
+import json
+import math
+import zlib
+from datetime import datetime, timezone
+from decimal import Decimal
+from connections import get_redis
+
+# Число шардов каждой сущности
+META_KEY = "layout:shards"
+# Поток изменённых записей, который читает инкрементальная миграция
+CHANGES_STREAM = "migration:changes"
+# Доля лимита listpack, до которой заполняются шарды (запас на рост)
+FILL_FACTOR = 0.75
+SCAN_COUNT = 1000
+BATCH_SIZE = 500
+REPORT_SAMPLE = 1000
+# Потолок, до которого convert поднимает hash-max-listpack-value: выше
+# поиск по listpack становится дороже экономии памяти
+LISTPACK_VALUE_MAX = 256
+
+# Поля записей в порядке хранения и способ их упаковки
+SCHEMAS = {
+    'bookings': {
+        'prefix': "booking:",
+        'id': 'book_ref',
+        'fields': [('book_date', 'date'), ('total_amount', 'kopecks')]
+    },
+    'flights': {
+        'prefix': "flight:",
+        'id': 'flight_id',
+        'fields': [('flight_no', 'str'), ('scheduled_departure', 'timestamp'),
+                   ('scheduled_arrival', 'timestamp')]
+    },
+    'tickets': {
+        'prefix': "ticket:",
+        'id': 'ticket_no',
+        'fields': [('book_ref', 'str'), ('passenger_name', 'str'), ('contact_data', 'json')]
+    }
+}
+
+DATE_FORMATS = {'date': '%Y-%m-%d', 'timestamp': '%Y-%m-%dT%H:%M:%S'}
+
+def pack_value(kind, value):
+    if kind in DATE_FORMATS:
+        return calendar.timegm(datetime.strptime(value, DATE_FORMATS[kind]).timetuple())
+    if kind == 'kopecks':
+        return int((Decimal(value) * 100).to_integral_value())
+    if kind == 'json':
+        # Вложенный объект вместо строки JSON в JSON - без экранирования кавычек
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+    return value
+
+def unpack_value(kind, value):
+    """Обратное преобразование в строку исходного формата хэша"""
+    if kind in DATE_FORMATS:
+        return datetime.fromtimestamp(value, timezone.utc).strftime(DATE_FORMATS[kind])
+    if kind == 'kopecks':
+        return f"{value // 100}.{value % 100:02d}"
+    if kind == 'json' and not isinstance(value, str):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+def pack_record(entity, data):
+    """Словарь исходного хэша -> (id, компактное значение поля шарда)"""
+    schema = SCHEMAS[entity]
+    values = [pack_value(kind, data[name]) for name, kind in schema['fields']]
+    return data[schema['id']], json.dumps(values, separators=(',', ':'), ensure_ascii=False)
+
+def unpack_record(entity, record_id, packed):
+    """Значение поля шарда -> словарь в формате исходного хэша"""
+    schema = SCHEMAS[entity]
+    data = {schema['id']: record_id}
+    for (name, kind), value in zip(schema['fields'], json.loads(packed)):
+        data[name] = unpack_value(kind, value)
+    return data
+
+def record_key(entity, record_id):
+    """Имя исходного ключа записи - под ним запись видна миграции"""
+    return f"{SCHEMAS[entity]['prefix']}{record_id}"
+
+def shard_key(entity, shard):
+    return f"{entity}:shard:{shard}"
+
+def shard_for(record_id, shards):
+    return zlib.crc32(str(record_id).encode()) % shards
+
+def get_shard_count(redis_conn, entity):
+    count = redis_conn.hget(META_KEY, entity)
+    return int(count) if count else None
+
+def listpack_limit(redis_conn, kind='entries'):
+    """hash-max-listpack-entries/value (hash-max-ziplist-* до Redis 7)"""
+    for name in (f'hash-max-listpack-{kind}', f'hash-max-ziplist-{kind}'):
+        value = redis_conn.config_get(name).get(name)
+        if value:
+            return int(value)
+    return 128 if kind == 'entries' else 64
+
+def ensure_value_limit(redis_conn, size, max_size=LISTPACK_VALUE_MAX):
+    """Лимит hash-max-listpack-value не меньше size байт.
+
+    Одно длинное значение переводит весь шард в hashtable, поэтому лимит
+    поднимается до записи. Если поднять его нельзя (CONFIG запрещён или
+    значение длиннее max_size), конвертация останавливается: раскладка
+    без listpack теряет смысл.
+    """
+    current = listpack_limit(redis_conn, 'value')
+    if size <= current:
+        return current
+    if size > max_size:
+        raise RuntimeError(f"значение {size} байт длиннее LISTPACK_VALUE_MAX ({max_size})")
+    # С запасом до кратного 32, чтобы не менять лимит на каждой пачке
+    size = min(max_size, math.ceil(size / 32) * 32)
+    for name in ('hash-max-listpack-value', 'hash-max-ziplist-value'):
+        try:
+            redis_conn.config_set(name, size)
+            break
+        except Exception as e:
+            error = e
+    else:
+        raise RuntimeError(f"не удалось поднять hash-max-listpack-value до {size}: {error}")
+    print(f"hash-max-listpack-value поднят с {current} до {size} байт - "
+          f"сохраните значение в конфигурации Redis (CONFIG REWRITE)")
+    return size
+
+def plan_shards(redis_conn, records):
+    """Число шардов, при котором шард заполнен listpack'ом на FILL_FACTOR"""
+    per_shard = max(1, int(listpack_limit(redis_conn) * FILL_FACTOR))
+    return max(1, math.ceil(records / per_shard))
+
+# --- Чтение для миграции ---
+
+def fetch_records(redis_conn, entity, keys):
+    """Аналог fetch_hashes: (ключ, словарь) для ключей вида booking:<id>.
+
+    Записи одного шарда читаются одним HMGET, все шарды - одним pipeline.
+    Для отсутствующих записей возвращается пустой словарь, как у HGETALL.
+    """
+    shards = get_shard_count(redis_conn, entity)
+    if not shards:
+        return [(key, {}) for key in keys]
+    prefix = SCHEMAS[entity]['prefix']
+    grouped = {}
+    for key in keys:
+        record_id = key[len(prefix):]
+        grouped.setdefault(shard_for(record_id, shards), []).append((key, record_id))
+
+    pipe = redis_conn.pipeline(transaction=False)
+    for shard, items in grouped.items():
+        pipe.hmget(shard_key(entity, shard), [record_id for _, record_id in items])
+    found = {}
+    for items, values in zip(grouped.values(), pipe.execute()):
+        for (key, record_id), packed in zip(items, values):
+            found[key] = unpack_record(entity, record_id, packed) if packed else {}
+    return [(key, found[key]) for key in keys]
+
+def shard_batches(redis_conn, entity, batch_size=BATCH_SIZE, bucket=None, cursor=0):
+    """Обход шардов пачками записей не меньше batch_size.
+
+    Как и scan_batches миграции, вместе с пачкой отдаётся курсор - номер
+    следующего шарда (0 - обход завершён). bucket=(номер, всего) оставляет
+    шарды своей корзины. Шард читается целиком одним HGETALL: он мал по
+    построению.
+    """
+    shards = get_shard_count(redis_conn, entity) or 0
+    batch = []
+    for shard in range(cursor, shards):
+        if bucket and shard % bucket[1] != bucket[0]:
+            continue
+        for record_id, packed in redis_conn.hgetall(shard_key(entity, shard)).items():
+            batch.append((record_key(entity, record_id),
+                          unpack_record(entity, record_id, packed)))
+        if len(batch) >= batch_size and shard + 1 < shards:
+            yield shard + 1, batch
+            batch = []
+    yield 0, batch
+
+# --- Запись ---
+
+def write_records(redis_conn, entity, records):
+    """Запись словарей в формате исходных хэшей в шарды с журналом изменений.
+
+    HSET в шард и XADD исходного ключа (booking:<book_ref> и т.д.) в
+    CHANGES_STREAM выполняются одной транзакцией - миграция с --incremental
+    не пропустит изменение и не увидит его раньше самой записи.
+    """
+    shards = get_shard_count(redis_conn, entity)
+    if not shards:
+        raise ValueError(f"{entity}: шарды не созданы - сначала выполните convert")
+    packed_records = [pack_record(entity, data) for data in records]
+    if packed_records:
+        ensure_value_limit(redis_conn, max(len(packed.encode()) for _, packed in packed_records))
+    pipe = redis_conn.pipeline(transaction=True)
+    for record_id, packed in packed_records:
+        pipe.hset(shard_key(entity, shard_for(record_id, shards)), record_id, packed)
+        pipe.xadd(CHANGES_STREAM, {'key': record_key(entity, record_id)})
+    pipe.execute()
+    return len(records)
+
+# --- Конвертация и отчёт ---
+
+def scan_keys(redis_conn, entity, scan_count=SCAN_COUNT):
+    yield from redis_conn.scan_iter(match=f"{SCHEMAS[entity]['prefix']}*", count=scan_count)
+
+def count_records(redis_conn, entity, batch_size=BATCH_SIZE):
+    """(записей в шардах, новых исходных ключей, всего исходных ключей).
+
+    После --drop-source шарды - единственная копия записей, поэтому их
+    содержимое учитывается по HLEN; исходный ключ, запись которого уже
+    есть в шарде, второй раз не считается.
+    """
+    previous = get_shard_count(redis_conn, entity)
+    stored = 0
+    if previous:
+        pipe = redis_conn.pipeline(transaction=False)
+        for shard in range(previous):
+            pipe.hlen(shard_key(entity, shard))
+        stored = sum(pipe.execute())
+
+    prefix = SCHEMAS[entity]['prefix']
+    sources = new = 0
+    batch = []
+
+    def flush():
+        nonlocal sources, new
+        sources += len(batch)
+        if not previous:
+            new += len(batch)
+        else:
+            pipe = redis_conn.pipeline(transaction=False)
+            for record_id in batch:
+                pipe.hexists(shard_key(entity, shard_for(record_id, previous)), record_id)
+            new += sum(1 for exists in pipe.execute() if not exists)
+        batch.clear()
+
+    for key in scan_keys(redis_conn, entity):
+        batch.append(key[len(prefix):])
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+    return stored, new, sources
+
+def reshard(redis_conn, entity, previous, shards, batch_size=BATCH_SIZE):
+    """Перекладка записей из previous шардов в shards.
+
+    Новые шарды собираются под временными именами и одной транзакцией
+    переименовываются в рабочие вместе со сменой числа шардов в META_KEY:
+    старые шарды удаляются только тогда, когда их записи уже скопированы.
+    """
+    def tmp_key(shard):
+        return f"{shard_key(entity, shard)}:resharding"
+
+    # Остатки прерванной перекладки
+    for shard in range(shards):
+        redis_conn.unlink(tmp_key(shard))
+
+    written = set()
+    for old in range(previous):
+        records = redis_conn.hgetall(shard_key(entity, old))
+        items = list(records.items())
+        for start in range(0, len(items), batch_size):
+            grouped = {}
+            for record_id, packed in items[start:start + batch_size]:
+                grouped.setdefault(shard_for(record_id, shards), {})[record_id] = packed
+            pipe = redis_conn.pipeline(transaction=False)
+            for shard, mapping in grouped.items():
+                pipe.hset(tmp_key(shard), mapping=mapping)
+            pipe.execute()
+            written.update(grouped)
+
+    pipe = redis_conn.pipeline(transaction=True)
+    for shard in range(max(previous, shards)):
+        if shard in written:
+            pipe.rename(tmp_key(shard), shard_key(entity, shard))
+        else:
+            pipe.unlink(shard_key(entity, shard))
+    pipe.hset(META_KEY, entity, shards)
+    pipe.execute()
+
+def convert(redis_conn, entity, batch_size=BATCH_SIZE, drop_source=False):
+    """Перенос ключей сущности в шарды; исходные ключи удаляются по drop_source"""
+    stored, new, sources = count_records(redis_conn, entity, batch_size)
+    if not sources:
+        print(f"{entity}: исходных ключей нет, шарды не изменены")
+        return 0
+    shards = plan_shards(redis_conn, stored + new)
+    previous = get_shard_count(redis_conn, entity)
+    if previous and previous != shards:
+        # Смена числа шардов меняет раскладку - записи перекладываются
+        reshard(redis_conn, entity, previous, shards, batch_size)
+        print(f"{entity}: {stored} записей переложено из {previous} в {shards} шардов")
+    else:
+        redis_conn.hset(META_KEY, entity, shards)
+
+    converted = errors = 0
+    batch = []
+
+    def flush():
+        nonlocal converted, errors
+        pipe = redis_conn.pipeline(transaction=False)
+        for key in batch:
+            pipe.hgetall(key)
+        packed_records = []
+        for key, data in zip(batch, pipe.execute()):
+            if not data:
+                continue
+            try:
+                packed_records.append((key, *pack_record(entity, data)))
+            except Exception as e:
+                errors += 1
+                print(f"Ошибка в ключе {key}: {str(e)}")
+        if packed_records:
+            # Лимит поднимается до HSET, пока шарды ещё listpack
+            ensure_value_limit(redis_conn, max(len(packed.encode())
+                                               for _, _, packed in packed_records))
+        writes = redis_conn.pipeline(transaction=False)
+        for key, record_id, packed in packed_records:
+            writes.hset(shard_key(entity, shard_for(record_id, shards)), record_id, packed)
+            if drop_source:
+                writes.unlink(key)
+            converted += 1
+        writes.execute()
+        batch.clear()
+
+    for key in scan_keys(redis_conn, entity):
+        batch.append(key)
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+
+    print(f"{entity}: {converted} записей в {shards} шардах, ошибок: {errors}")
+    not_listpack = count_not_listpack(redis_conn, entity, shards)
+    if not_listpack:
+        # hashtable обратно в listpack сам не возвращается - шард нужно пересоздать
+        print(f"  {not_listpack} шардов хранятся не listpack: экономии памяти нет, "
+              f"пересоздайте их (удаление шардов и convert из исходных ключей)")
+    return converted
+
+def count_not_listpack(redis_conn, entity, shards):
+    """Число шардов, которые Redis хранит не listpack'ом"""
+    pipe = redis_conn.pipeline(transaction=False)
+    for shard in range(shards):
+        pipe.object("encoding", shard_key(entity, shard))
+    return sum(1 for encoding in pipe.execute()
+               if encoding and encoding not in ('listpack', 'ziplist'))
+
+def memory_usage(redis_conn, keys):
+    pipe = redis_conn.pipeline(transaction=False)
+    for key in keys:
+        pipe.execute_command("MEMORY USAGE", key, "SAMPLES", "0")
+    return sum(size or 0 for size in pipe.execute())
+
+def report(redis_conn, entity, sample=REPORT_SAMPLE):
+    """Байт на запись: исходные ключи (по выборке) и шарды (полностью)"""
+    result = {'entity': entity}
+
+    keys = []
+    for key in scan_keys(redis_conn, entity):
+        keys.append(key)
+        if len(keys) >= sample:
+            break
+    if keys:
+        result['before'] = memory_usage(redis_conn, keys) / len(keys)
+
+    shards = get_shard_count(redis_conn, entity)
+    if shards:
+        names = [shard_key(entity, shard) for shard in range(shards)]
+        pipe = redis_conn.pipeline(transaction=False)
+        for name in names:
+            pipe.hlen(name)
+            pipe.object("encoding", name)
+        replies = pipe.execute()
+        records = sum(replies[0::2])
+        encodings = {}
+        for encoding in replies[1::2]:
+            if encoding:
+                encodings[encoding] = encodings.get(encoding, 0) + 1
+        if records:
+            result['after'] = memory_usage(redis_conn, names) / records
+        result['shards'] = shards
+        result['encodings'] = encodings
+
+    line = f"{entity}:"
+    if 'before' in result:
+        line += f" ключи {result['before']:.1f} байт/запись"
+    if 'after' in result:
+        line += f", шарды {result['after']:.1f} байт/запись"
+        encodings = ", ".join(f"{name} x{count}" for name, count in result['encodings'].items())
+        line += f" ({result['shards']} шт.: {encodings})"
+    if 'before' in result and 'after' in result:
+        line += f", экономия {1 - result['after'] / result['before']:.0%}"
+    print(line)
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Шардированная раскладка записей в Redis")
+    parser.add_argument("command", choices=("convert", "report"))
+    parser.add_argument("--entity", choices=list(SCHEMAS), action="append",
+                        help="сущность (по умолчанию все)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help="ключей в одном pipeline")
+    parser.add_argument("--drop-source", action="store_true",
+                        help="удалять исходные ключи после переноса")
+    parser.add_argument("--sample", type=int, default=REPORT_SAMPLE,
+                        help="исходных ключей в выборке для отчёта")
+    args = parser.parse_args()
+
+    redis_conn = get_redis(decode_responses=True)
+    for entity in args.entity or SCHEMAS:
+        if args.command == "convert":
+            convert(redis_conn, entity, args.batch_size, args.drop_source)
+        else:
+            report(redis_conn, entity, args.sample)
@@ -0,0 +1,258 @@
+"""Предрасчитанная статистика маршрутов вместо запроса route_analysis.
+
+route_analysis из time-test.py на каждом запуске соединяет flights с
+ticket_flights и для каждого маршрута считает коррелированный COUNT(*)
+по flights. Здесь те же показатели хранятся в таблице route_stats и
+дополняются только прибывшими с прошлого обновления рейсами:
+route_stats_applied помнит уже учтённые рейсы, поэтому повторный или
+параллельный refresh ничего не посчитает дважды.
+
+    python route-stats.py setup     # таблицы и индексы
+    python route-stats.py rebuild   # полный пересчёт
+    python route-stats.py refresh   # учесть новые прибывшие рейсы
+    python route-stats.py rank      # рейтинг маршрутов по выручке
+"""
+import argparse
+import time
+from connections import acquire_pg, release_pg
+
+# Дальнемагистральные самолёты - как в route_analysis
+LONG_RANGE_KM = 3000
+REFRESH_BATCH = 1000
+RANK_LIMIT = 100
+
+SETUP_SQL = """
+    CREATE TABLE IF NOT EXISTS route_stats (
+        departure_airport char(3) NOT NULL,
+        arrival_airport char(3) NOT NULL,
+        flight_count integer NOT NULL DEFAULT 0,
+        ticket_count bigint NOT NULL DEFAULT 0,
+        duration_sum interval NOT NULL DEFAULT interval '0',
+        revenue numeric NOT NULL DEFAULT 0,
+        long_range_flights integer NOT NULL DEFAULT 0,
+        updated_at timestamptz NOT NULL DEFAULT now(),
+        PRIMARY KEY (departure_airport, arrival_airport)
+    );
+
+    CREATE TABLE IF NOT EXISTS route_stats_applied (
+        flight_id integer PRIMARY KEY
+    );
+
+    -- Поиск ещё не учтённых прибывших рейсов и их билетов
+    CREATE INDEX IF NOT EXISTS flights_arrived_idx
+        ON flights (flight_id) WHERE status = 'Arrived';
+    CREATE INDEX IF NOT EXISTS ticket_flights_flight_id_idx
+        ON ticket_flights (flight_id);
+"""
+
+# Учёт прибывших рейсов, которых нет в route_stats_applied, одним оператором.
+# ON CONFLICT DO NOTHING ... RETURNING отдаёт только рейсы, вставленные этой
+# транзакцией, так что параллельные обновления не учитывают рейс дважды.
+# ticket_count и duration_sum взвешены по билетам, как COUNT(*) и AVG
+# в route_analysis, flight_count - число самих рейсов.
+APPLY_SQL = """
+    WITH new_flights AS (
+        INSERT INTO route_stats_applied (flight_id)
+        SELECT f.flight_id
+        FROM flights f
+        WHERE f.status = 'Arrived'
+          AND NOT EXISTS (
+              SELECT 1 FROM route_stats_applied a WHERE a.flight_id = f.flight_id
+          )
+        ORDER BY f.flight_id
+        LIMIT %(batch)s
+        ON CONFLICT DO NOTHING
+        RETURNING flight_id
+    ),
+    delta AS (
+        SELECT
+            f.departure_airport,
+            f.arrival_airport,
+            COUNT(DISTINCT f.flight_id) AS flight_count,
+            COUNT(tf.flight_id) AS ticket_count,
+            COALESCE(SUM(f.actual_arrival - f.actual_departure)
+                     FILTER (WHERE tf.flight_id IS NOT NULL), interval '0') AS duration_sum,
+            COALESCE(SUM(tf.amount), 0) AS revenue
+        FROM new_flights n
+        JOIN flights f ON f.flight_id = n.flight_id
+        LEFT JOIN ticket_flights tf ON tf.flight_id = f.flight_id
+        GROUP BY f.departure_airport, f.arrival_airport
+    )
+    INSERT INTO route_stats AS rs
+        (departure_airport, arrival_airport, flight_count, ticket_count, duration_sum, revenue)
+    SELECT departure_airport, arrival_airport, flight_count, ticket_count, duration_sum, revenue
+    FROM delta
+    ON CONFLICT (departure_airport, arrival_airport) DO UPDATE SET
+        flight_count = rs.flight_count + EXCLUDED.flight_count,
+        ticket_count = rs.ticket_count + EXCLUDED.ticket_count,
+        duration_sum = rs.duration_sum + EXCLUDED.duration_sum,
+        revenue = rs.revenue + EXCLUDED.revenue,
+        updated_at = now()
+    RETURNING departure_airport, arrival_airport
+"""
+
+# Число рейсов дальнемагистральными самолётами - по всем рейсам маршрута,
+# независимо от статуса; пересчитывается только для затронутых маршрутов
+LONG_RANGE_SQL = """
+    UPDATE route_stats rs
+    SET long_range_flights = lr.long_range_flights
+    FROM (
+        SELECT f.departure_airport, f.arrival_airport,
+               COUNT(*) FILTER (WHERE a.range > %(range)s) AS long_range_flights
+        FROM flights f
+        JOIN aircrafts a ON a.aircraft_code = f.aircraft_code
+        WHERE (f.departure_airport, f.arrival_airport) IN %(routes)s
+        GROUP BY f.departure_airport, f.arrival_airport
+    ) lr
+    WHERE rs.departure_airport = lr.departure_airport
+      AND rs.arrival_airport = lr.arrival_airport
+"""
+
+# Те же столбцы, что у route_analysis, но из ~сотен строк route_stats
+RANK_SQL = """
+    SELECT
+        rs.departure_airport,
+        rs.arrival_airport,
+        rs.ticket_count AS total_flights,
+        rs.duration_sum / rs.ticket_count AS avg_duration,
+        rs.revenue AS total_revenue,
+        a1.airport_name AS departure_name,
+        a2.airport_name AS arrival_name,
+        a1.city AS departure_city,
+        a2.city AS arrival_city,
+        rs.long_range_flights,
+        RANK() OVER (ORDER BY rs.revenue DESC) AS revenue_rank
+    FROM route_stats rs
+    JOIN airports a1 ON rs.departure_airport = a1.airport_code
+    JOIN airports a2 ON rs.arrival_airport = a2.airport_code
+    WHERE rs.ticket_count > 0
+    ORDER BY rs.revenue DESC
+    LIMIT %s
+"""
+
+def setup(pg_conn):
+    """Создание таблиц статистики и индексов для обновления"""
+    with pg_conn.cursor() as cursor:
+        cursor.execute(SETUP_SQL)
+    pg_conn.commit()
+    print("Таблицы route_stats и route_stats_applied готовы")
+
+def apply_arrived(cursor, batch=REFRESH_BATCH, long_range_km=LONG_RANGE_KM):
+    """Учёт пачки новых прибывших рейсов; возвращает затронутые маршруты.
+
+    batch=None - все неучтённые рейсы сразу (LIMIT NULL).
+    """
+    cursor.execute(APPLY_SQL, {'batch': batch})
+    routes = sorted(set(cursor.fetchall()))
+    if routes:
+        cursor.execute(LONG_RANGE_SQL, {'range': long_range_km, 'routes': tuple(routes)})
+    return routes
+
+def refresh(pg_conn, batch=REFRESH_BATCH, long_range_km=LONG_RANGE_KM):
+    """Инкрементальное обновление: пачки рейсов, каждая в своей транзакции"""
+    start_time = time.perf_counter()
+    touched = set()
+    while True:
+        try:
+            with pg_conn.cursor() as cursor:
+                routes = apply_arrived(cursor, batch, long_range_km)
+            pg_conn.commit()
+        except Exception:
+            pg_conn.rollback()
+            raise
+        if not routes:
+            break
+        touched.update(routes)
+
+    print(f"Обновлено маршрутов: {len(touched)} за {time.perf_counter() - start_time:.2f} сек")
+    return touched
+
+def rebuild(pg_conn, long_range_km=LONG_RANGE_KM):
+    """Полный пересчёт в одной транзакции: читатели видят старую статистику до COMMIT.
+
+    DELETE вместо TRUNCATE: TRUNCATE берёт ACCESS EXCLUSIVE и блокирует
+    rank и refresh на всё время пересчёта, а таблицы здесь небольшие.
+    """
+    start_time = time.perf_counter()
+    try:
+        with pg_conn.cursor() as cursor:
+            cursor.execute("DELETE FROM route_stats")
+            cursor.execute("DELETE FROM route_stats_applied")
+            routes = apply_arrived(cursor, None, long_range_km)
+        pg_conn.commit()
+    except Exception:
+        pg_conn.rollback()
+        raise
+    print(f"Пересчитано маршрутов: {len(routes)} за {time.perf_counter() - start_time:.2f} сек")
+    return routes
+
+def rank_routes(pg_conn, limit=RANK_LIMIT):
+    """Рейтинг маршрутов по выручке: (строки, столбцы, время в секундах)"""
+    start_time = time.perf_counter()
+    with pg_conn.cursor() as cursor:
+        cursor.execute(RANK_SQL, (limit,))
+        rows = cursor.fetchall()
+        columns = [desc[0] for desc in cursor.description]
+    pg_conn.rollback()
+    return rows, columns, time.perf_counter() - start_time
+
+def route_rank(pg_conn, departure_airport, arrival_airport):
+    """Место одного маршрута по выручке (как RANK: равные делят место)"""
+    with pg_conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT 1 + (
+                SELECT COUNT(*) FROM route_stats other
+                WHERE other.ticket_count > 0 AND other.revenue > rs.revenue
+            )
+            FROM route_stats rs
+            WHERE rs.departure_airport = %s AND rs.arrival_airport = %s
+              AND rs.ticket_count > 0
+        """, (departure_airport, arrival_airport))
+        row = cursor.fetchone()
+    pg_conn.rollback()
+    return row[0] if row else None
+
+def print_rank(rows, columns, elapsed):
+    print(f"\n=== Маршруты по выручке ({elapsed * 1000:.1f} мс) ===")
+    for row in rows:
+        route = dict(zip(columns, row))
+        print(f"{route['revenue_rank']:>3}. {route['departure_city']} ({route['departure_airport']}) -> "
+              f"{route['arrival_city']} ({route['arrival_airport']}): "
+              f"{route['total_revenue']:.2f} руб., билетов {route['total_flights']}, "
+              f"дальнемагистральных рейсов {route['long_range_flights']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Статистика маршрутов в route_stats")
+    parser.add_argument("command", choices=("setup", "rebuild", "refresh", "rank"))
+    parser.add_argument("--batch", type=int, default=REFRESH_BATCH,
+                        help="рейсов за одну транзакцию refresh")
+    parser.add_argument("--long-range-km", type=int, default=LONG_RANGE_KM,
+                        help="дальность самолёта, с которой рейс считается дальнемагистральным")
+    parser.add_argument("--limit", type=int, default=RANK_LIMIT, help="маршрутов в рейтинге")
+    parser.add_argument("--route", nargs=2, metavar=("FROM", "TO"),
+                        help="место одного маршрута в рейтинге")
+    parser.add_argument("--interval", type=float, default=0,
+                        help="для refresh: повторять каждые N секунд")
+    args = parser.parse_args()
+
+    pg_conn = acquire_pg()
+    try:
+        if args.command == "setup":
+            setup(pg_conn)
+        elif args.command == "rebuild":
+            rebuild(pg_conn, args.long_range_km)
+        elif args.command == "refresh":
+            refresh(pg_conn, args.batch, args.long_range_km)
+            while args.interval:
+                time.sleep(args.interval)
+                refresh(pg_conn, args.batch, args.long_range_km)
+        elif args.route:
+            rank = route_rank(pg_conn, *args.route)
+            print(f"Маршрут {args.route[0]} -> {args.route[1]}: "
+                  f"{'нет данных' if rank is None else f'место {rank}'}")
+        else:
+            print_rank(*rank_routes(pg_conn, args.limit))
+    except Exception as e:
+        print(f"Ошибка: {str(e)}")
+    finally:
+        release_pg(pg_conn)
@@ -1,25 +1,60 @@
-import psycopg2
-import redis
+import argparse
+import random
+import subprocess
+import sys
+import threading
 import time
 import json
+import hashlib
+import re
+import statistics
+import uuid
+import weakref
 import pandas as pd
+from collections import defaultdict
 from datetime import datetime, date, timedelta
 from decimal import Decimal
+from connections import (acquire_pg, configure_pools, get_redis, print_acquire_metrics,
+                         release_pg)
 
-# Конфигурация подключений
-POSTGRES_CONFIG = {
-    "host": "192.168.50.24",
-    "database": "demo",
-    "user": "postgres",
-    "password": "postgres"
-}
+# Необязательное сжатие кэшированных результатов
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Read-through кэш запросов
+CACHE_PREFIX = "qcache"
+CACHE_TTL = 3600
+STALE_TTL = 24 * 3600       # сколько живёт устаревшая копия результата
+LOCK_TTL = 30               # сек, за которые пересчёт обязан уложиться
+LOCK_WAIT = 10              # сек ожидания чужого пересчёта
+LOCK_POLL = 0.05
+CACHED_TABLES = ('bookings', 'tickets', 'ticket_flights', 'flights')
+
+# Удаление блокировки только её владельцем
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Параметры бенчмарка
+WARMUP = 3
+ITERATIONS = 30
+REGRESSION_THRESHOLD = 0.10     # рост p50 больше чем на 10% - регрессия
+
+# Параметры нагрузочного режима
+LOAD_CONCURRENCY = (1, 4, 16, 64)
+LOAD_DURATION = 10              # сек на каждый уровень
+LOAD_WARMUP = 2                 # сек непрерывного прогрева перед каждым уровнем
+LOAD_MISS_RATIO = 0.1           # доля запросов к кэшу, принудительно идущих в PostgreSQL
 
-REDIS_CONFIG = {
-    "host": "192.168.50.24",
-    "port": 6379,
-    "db": 0,
-    "decode_responses": False
-}
 QUERIES = {
     "booking_stats": """
     SELECT 
@@ -89,6 +124,26 @@ QUERIES = {
     LIMIT 100;
     """
 }
+
+# Параметры подготовленных вариантов QUERIES: (тип, фрагмент текста, шаблон замены, значение)
+PREPARED_PARAMS = {
+    "booking_stats": [
+        ("integer", "LIMIT 10", "LIMIT {}", 10),
+    ],
+    "scheduled_flights": [
+        ("text", "f.status = 'Scheduled'", "f.status = {}", "Scheduled"),
+        ("integer", "LIMIT 10", "LIMIT {}", 10),
+    ],
+    "route_analysis": [
+        ("text", "f.status = 'Arrived'", "f.status = {}", "Arrived"),
+        ("integer", "range > 3000", "range > {}", 3000),
+        ("integer", "LIMIT 100", "LIMIT {}", 100),
+    ],
+}
+
+# Подготовленные запросы каждого соединения (PREPARE живёт в рамках сессии)
+_prepared = weakref.WeakKeyDictionary()
+
 # Улучшенный JSON-энкодер для всех типов PostgreSQL
 class PGDataEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -116,51 +171,247 @@ def convert_pg_data(data):
         return float(data)
     return data
 
-def execute_query(pg_conn, query):
+# Типы колонок для колоночного формата: (тег, тип, кодирование, декодирование).
+# bool раньше int и datetime раньше date - из-за наследования.
+COLUMN_TYPES = (
+    ('bool', bool, None, None),
+    ('int', int, None, None),
+    ('float', float, None, None),
+    ('decimal', Decimal, str, Decimal),
+    ('datetime', datetime, datetime.isoformat, datetime.fromisoformat),
+    ('date', date, date.isoformat, date.fromisoformat),
+    ('interval', timedelta, timedelta.total_seconds, lambda value: timedelta(seconds=value)),
+    ('str', str, None, None),
+)
+COLUMN_ENCODERS = {tag: encode for tag, _, encode, _ in COLUMN_TYPES}
+COLUMN_DECODERS = {tag: decode for tag, _, _, decode in COLUMN_TYPES}
+
+def column_type(values):
+    """Тег типа колонки по первому непустому значению"""
+    for value in values:
+        if value is None:
+            continue
+        for tag, kind, _, _ in COLUMN_TYPES:
+            if isinstance(value, kind):
+                return tag
+        return 'json'
+    return 'json'
+
+class JsonRowsCodec:
+    """Строки как JSON-словари: имена колонок повторяются в каждой строке"""
+    name = "json_rows"
+
+    def encode(self, rows, columns):
+        return json.dumps([dict(zip(columns, row)) for row in rows], cls=PGDataEncoder).encode()
+
+    def decode(self, payload):
+        records = json.loads(payload)
+        columns = list(records[0]) if records else []
+        return [[record[col] for col in columns] for record in records], columns
+
+class ColumnarCodec:
+    """Колоночный формат: имена колонок один раз, типизированные массивы значений"""
+    name = "columnar"
+
+    def encode(self, rows, columns):
+        arrays = [list(values) for values in zip(*rows)] if rows else [[] for _ in columns]
+        types = [column_type(values) for values in arrays]
+        data = []
+        for tag, values in zip(types, arrays):
+            encode = COLUMN_ENCODERS.get(tag)
+            data.append([value if value is None or encode is None else encode(value)
+                         for value in values])
+        return json.dumps({"c": columns, "t": types, "v": data},
+                          cls=PGDataEncoder, separators=(",", ":")).encode()
+
+    def decode(self, payload):
+        data = json.loads(payload)
+        arrays = []
+        for tag, values in zip(data["t"], data["v"]):
+            decode = COLUMN_DECODERS.get(tag)
+            arrays.append([value if value is None or decode is None else decode(value)
+                           for value in values])
+        return [list(row) for row in zip(*arrays)], data["c"]
+
+class CompressedCodec:
+    """Обёртка, сжимающая результат другого кодека"""
+
+    def __init__(self, inner, suffix, compress, decompress):
+        self.inner = inner
+        self.name = f"{inner.name}+{suffix}"
+        self.compress = compress
+        self.decompress = decompress
+
+    def encode(self, rows, columns):
+        return self.compress(self.inner.encode(rows, columns))
+
+    def decode(self, payload):
+        return self.inner.decode(self.decompress(payload))
+
+CODECS = {codec.name: codec for codec in (JsonRowsCodec(), ColumnarCodec())}
+if zstandard is not None:
+    codec = CompressedCodec(CODECS["columnar"], "zstd",
+                            lambda data: zstandard.compress(data, 3), zstandard.decompress)
+    CODECS[codec.name] = codec
+if lz4 is not None:
+    codec = CompressedCodec(CODECS["columnar"], "lz4", lz4.frame.compress, lz4.frame.decompress)
+    CODECS[codec.name] = codec
+DEFAULT_CODEC = "columnar"
+
+def encode_payload(rows, columns, codec_name=DEFAULT_CODEC):
+    """Сериализация результата; имя кодека пишется в начало значения"""
+    return codec_name.encode() + b":" + CODECS[codec_name].encode(rows, columns)
+
+def decode_payload(payload):
+    """Разбор значения из кэша кодеком, имя которого записано в его начале"""
+    codec_name, body = payload.split(b":", 1)
+    return CODECS[codec_name.decode()].decode(body)
+
+def execute_query(pg_conn, query, params=None):
     """Выполнение SQL-запроса и возврат результатов"""
     with pg_conn.cursor() as cursor:
         start_time = time.time()
-        cursor.execute(query)
+        cursor.execute(query, params)
         result = cursor.fetchall()
         columns = [desc[0] for desc in cursor.description]
         duration = time.time() - start_time
     return result, columns, duration
 
-def cache_to_redis(redis_conn, key, data, columns, ttl=3600):
-    """Кэширование данных в Redis с полной конвертацией типов"""
+def prepared_sql(query_name):
+    """Текст запроса из QUERIES с фильтрами и LIMIT, заменёнными на $1, $2, ..."""
+    sql = QUERIES[query_name].strip().rstrip(";")
+    for n, (_, fragment, template, _) in enumerate(PREPARED_PARAMS[query_name], 1):
+        if fragment not in sql:
+            raise ValueError(f"В запросе {query_name} нет фрагмента {fragment!r}")
+        sql = sql.replace(fragment, template.format(f"${n}"))
+    return sql
+
+def prepare_query(pg_conn, query_name, params=None):
+    """PREPARE один раз на соединение; возвращает текст EXECUTE и его параметры"""
+    prepared = _prepared.setdefault(pg_conn, set())
+    spec = PREPARED_PARAMS[query_name]
+    if query_name not in prepared:
+        types = ", ".join(sql_type for sql_type, _, _, _ in spec)
+        with pg_conn.cursor() as cursor:
+            cursor.execute(f"PREPARE {query_name} ({types}) AS {prepared_sql(query_name)}")
+        prepared.add(query_name)
+
+    if params is None:
+        params = [value for _, _, _, value in spec]
+    return f"EXECUTE {query_name} ({', '.join(['%s'] * len(params))})", params
+
+def execute_prepared(pg_conn, query_name, params=None):
+    """Выполнение подготовленного запроса через EXECUTE"""
+    sql, params = prepare_query(pg_conn, query_name, params)
+    return execute_query(pg_conn, sql, params)
+
+def cache_to_redis(redis_conn, key, data, columns, ttl=3600, codec=DEFAULT_CODEC):
+    """Кэширование данных в Redis выбранным кодеком"""
     try:
-        # Преобразуем в список словарей с конвертацией всех специальных типов
-        dict_data = []
-        for row in data:
-            row_dict = {}
-            for i, col in enumerate(columns):
-                row_dict[col] = convert_pg_data(row[i])
-            dict_data.append(row_dict)
-        
-        redis_conn.setex(key, ttl, json.dumps(dict_data, cls=PGDataEncoder))
+        redis_conn.setex(key, ttl, encode_payload(data, columns, codec))
         return True
     except Exception as e:
         print(f"Подробная ошибка при кэшировании: {str(e)}")
         return False
 
 def get_from_redis(redis_conn, key):
-    """Получение данных из Redis"""
+    """Получение данных из Redis: ((строки, колонки), время)"""
     start_time = time.time()
     cached_data = redis_conn.get(key)
     duration = time.time() - start_time
     if cached_data:
-        return json.loads(cached_data), duration
+        return decode_payload(cached_data), duration
     return None, duration
 
+def normalize_sql(query):
+    """Нормализация текста запроса для ключа кэша (схлопывание пробелов)"""
+    return " ".join(query.split()).rstrip(";").strip()
+
+def query_tables(query):
+    """Таблицы из CACHED_TABLES, которые читает запрос"""
+    names = re.findall(r'\b(?:from|join)\s+([a-z_][a-z0-9_]*)', query, re.IGNORECASE)
+    return sorted({name.lower() for name in names} & set(CACHED_TABLES))
+
+def tag_key(table):
+    return f"{CACHE_PREFIX}:tag:{table}"
+
+def query_cache_keys(redis_conn, query, params=None):
+    """Ключи результата, устаревшей копии и блокировки для запроса.
+
+    В ключ результата входят версии тегов таблиц, поэтому после
+    invalidate_tables старые записи просто перестают находиться
+    и доживают до своего TTL.
+    """
+    tables = query_tables(query)
+    versions = redis_conn.mget([tag_key(table) for table in tables]) if tables else []
+    versions = [int(version or 0) for version in versions]
+
+    digest = hashlib.sha256(
+        json.dumps([normalize_sql(query), params], cls=PGDataEncoder).encode()
+    ).hexdigest()
+    key = f"{CACHE_PREFIX}:{digest}:" + ".".join(map(str, versions))
+    return key, f"{CACHE_PREFIX}:stale:{digest}", f"{key}:lock"
+
+def invalidate_tables(redis_conn, *tables):
+    """Инвалидация всех запросов, читающих таблицы, за O(число тегов)"""
+    pipe = redis_conn.pipeline(transaction=False)
+    for table in tables:
+        pipe.incr(tag_key(table))
+    pipe.execute()
+
+def cached_query(pg_conn, redis_conn, query, params=None, ttl=CACHE_TTL, serve_stale=False,
+                 codec=DEFAULT_CODEC):
+    """Read-through кэш вокруг execute_query.
+
+    При промахе пересчитывает только клиент, взявший блокировку ключа;
+    остальные ждут его результата или, при serve_stale, сразу получают
+    устаревшую копию. Возвращает (строки, колонки, источник).
+    """
+    key, stale_key, lock_key = query_cache_keys(redis_conn, query, params)
+    deadline = time.monotonic() + LOCK_WAIT
+
+    while True:
+        cached = redis_conn.get(key)
+        if cached is not None:
+            rows, columns = decode_payload(cached)
+            return rows, columns, 'cache'
+
+        token = uuid.uuid4().hex
+        if redis_conn.set(lock_key, token, nx=True, ex=LOCK_TTL):
+            try:
+                data, columns, _ = execute_query(pg_conn, query, params)
+                payload = encode_payload(data, columns, codec)
+                pipe = redis_conn.pipeline(transaction=False)
+                pipe.setex(key, ttl, payload)
+                pipe.setex(stale_key, STALE_TTL, payload)
+                pipe.execute()
+                return data, columns, 'db'
+            finally:
+                redis_conn.eval(RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+
+        if serve_stale:
+            stale = redis_conn.get(stale_key)
+            if stale is not None:
+                rows, columns = decode_payload(stale)
+                return rows, columns, 'stale'
+
+        if time.monotonic() > deadline:
+            # Владелец блокировки не успел - считаем сами, без записи в кэш
+            data, columns, _ = execute_query(pg_conn, query, params)
+            return data, columns, 'db'
+        time.sleep(LOCK_POLL)
+
 def clear_caches(redis_conn, pg_conn):
     """Очистка кэшей"""
     redis_conn.flushdb()
     pg_conn.reset()
+    # Сброс сессии удаляет и подготовленные запросы
+    _prepared.pop(pg_conn, None)
 
 def run_performance_test():
     """Запуск тестирования производительности"""
-    pg_conn = psycopg2.connect(**POSTGRES_CONFIG)
-    redis_conn = redis.Redis(**REDIS_CONFIG)
+    pg_conn = acquire_pg()
+    redis_conn = get_redis()
     
     results = []
     
@@ -182,6 +433,7 @@ def run_performance_test():
                 "pg_cold": pg_cold_time,
                 "redis": None,
                 "pg_warm": None,
+                "read_through": None,
                 "redis_vs_cold": None,
                 "redis_vs_warm": None
             })
@@ -196,13 +448,21 @@ def run_performance_test():
         # 4. Теплый запуск PostgreSQL
         pg_data_warm, _, pg_warm_time = execute_query(pg_conn, query)
         print(f"PostgreSQL (теплый): {pg_warm_time:.4f} сек")
-        
+
+        # 5. Read-through кэш: первый вызов заполняет, второй попадает в кэш
+        cached_query(pg_conn, redis_conn, query)
+        start_time = time.time()
+        cached_query(pg_conn, redis_conn, query)
+        read_through_time = time.time() - start_time
+        print(f"Read-through кэш (попадание): {read_through_time:.4f} сек")
+
         # Сохраняем результаты
         results.append({
             "query": query_name,
             "pg_cold": pg_cold_time,
             "redis": redis_time,
             "pg_warm": pg_warm_time,
+            "read_through": read_through_time,
             "redis_vs_cold": pg_cold_time / redis_time if redis_time else None,
             "redis_vs_warm": pg_warm_time / redis_time if redis_time else None
         })
@@ -212,7 +472,345 @@ def run_performance_test():
     df = pd.DataFrame(results)
     print(df.to_string())
     
-    pg_conn.close()
+    release_pg(pg_conn)
+
+def run_codec_report(repeats=5):
+    """Сравнение кодеков кэша: размер значения и время кодирования/декодирования"""
+    pg_conn = acquire_pg()
+
+    results = []
+    try:
+        for query_name, query in QUERIES.items():
+            data, columns, _ = execute_query(pg_conn, query)
+            for codec_name in CODECS:
+                encode_times, decode_times = [], []
+                for _ in range(repeats):
+                    start_time = time.perf_counter()
+                    payload = encode_payload(data, columns, codec_name)
+                    encode_times.append(time.perf_counter() - start_time)
+
+                    start_time = time.perf_counter()
+                    decode_payload(payload)
+                    decode_times.append(time.perf_counter() - start_time)
+
+                results.append({
+                    "query": query_name,
+                    "codec": codec_name,
+                    "bytes": len(payload),
+                    "encode_ms": statistics.median(encode_times) * 1000,
+                    "decode_ms": statistics.median(decode_times) * 1000
+                })
+    finally:
+        release_pg(pg_conn)
+
+    print("\n=== Кодеки кэша ===")
+    print(pd.DataFrame(results).to_string())
+
+def percentile(values, p):
+    """Перцентиль с линейной интерполяцией между соседними значениями"""
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+def summarize(samples_ns):
+    """Сводка по замерам в наносекундах, результат в миллисекундах"""
+    values = [sample / 1e6 for sample in samples_ns]
+    return {
+        "n": len(values),
+        "p50_ms": percentile(values, 50),
+        "p95_ms": percentile(values, 95),
+        "p99_ms": percentile(values, 99),
+        "mean_ms": statistics.fmean(values),
+        "stddev_ms": statistics.stdev(values) if len(values) > 1 else 0.0
+    }
+
+def time_pg_query(pg_conn, query, params=None):
+    """Одно выполнение запроса: execute (сервер + передача) и fetch (разбор строк), нс"""
+    with pg_conn.cursor() as cursor:
+        start_time = time.perf_counter_ns()
+        cursor.execute(query, params)
+        executed = time.perf_counter_ns()
+        rows = cursor.fetchall()
+        fetched = time.perf_counter_ns()
+        columns = [desc[0] for desc in cursor.description]
+    return rows, columns, {
+        "pg_execute": executed - start_time,
+        "pg_fetch": fetched - executed,
+        "pg_total": fetched - start_time
+    }
+
+def time_redis_read(redis_conn, key):
+    """Одно чтение из кэша: GET и декодирование значения, нс"""
+    start_time = time.perf_counter_ns()
+    payload = redis_conn.get(key)
+    received = time.perf_counter_ns()
+    decode_payload(payload)
+    decoded = time.perf_counter_ns()
+    return {
+        "redis_get": received - start_time,
+        "redis_decode": decoded - received,
+        "redis_total": decoded - start_time
+    }
+
+def explain_query(pg_conn, query, params=None):
+    """EXPLAIN (ANALYZE, BUFFERS): время планирования, выполнения и буферы"""
+    with pg_conn.cursor() as cursor:
+        cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query, params)
+        plan = cursor.fetchone()[0][0]
+    root = plan["Plan"]
+    return {
+        "planning_ms": plan["Planning Time"],
+        "execution_ms": plan["Execution Time"],
+        "shared_hit_blocks": root.get("Shared Hit Blocks", 0),
+        "shared_read_blocks": root.get("Shared Read Blocks", 0),
+        "plan": plan
+    }
+
+def run_cold_command(pg_conn, cold_command):
+    """Сброс кэшей внешней командой и переподключение к PostgreSQL.
+
+    pg_conn.reset() не трогает ни shared buffers, ни page cache ОС -
+    для настоящего холодного запуска нужна команда вроде перезапуска
+    PostgreSQL и drop_caches на сервере БД.
+    """
+    release_pg(pg_conn, close=True)
+    subprocess.run(cold_command, shell=True, check=True)
+    return acquire_pg()
+
+def compare_with_baseline(records, baseline_path, threshold=REGRESSION_THRESHOLD):
+    """Сравнение p50 с сохранённым прогоном; возвращает список регрессий"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {(r["query"], r["metric"]): r for r in json.load(f)["records"]}
+
+    regressions = []
+    for record in records:
+        previous = baseline.get((record["query"], record["metric"]))
+        if not previous or not previous["p50_ms"]:
+            continue
+        change = record["p50_ms"] / previous["p50_ms"] - 1
+        record["baseline_p50_ms"] = previous["p50_ms"]
+        record["change"] = change
+        if change > threshold:
+            regressions.append(record)
+    return regressions
+
+def run_benchmark(warmup=WARMUP, iterations=ITERATIONS, codec=DEFAULT_CODEC, cold_command=None,
+                  cold_iterations=0, output=None, baseline=None, threshold=REGRESSION_THRESHOLD):
+    """Бенчмарк запросов: прогрев, серия замеров и перцентили по каждой фазе"""
+    pg_conn = acquire_pg()
+    redis_conn = get_redis()
+
+    records = []
+    explains = {}
+    try:
+        for query_name, query in QUERIES.items():
+            print(f"\n=== Бенчмарк запроса: {query_name} ===")
+            samples = defaultdict(list)
+
+            # Холодные замеры - только с внешней командой сброса кэшей
+            if cold_command:
+                for _ in range(cold_iterations):
+                    pg_conn = run_cold_command(pg_conn, cold_command)
+                    _, _, timings = time_pg_query(pg_conn, query)
+                    samples["pg_cold_total"].append(timings["pg_total"])
+
+            for i in range(warmup + iterations):
+                rows, columns, timings = time_pg_query(pg_conn, query)
+                if i >= warmup:
+                    for metric, value in timings.items():
+                        samples[metric].append(value)
+
+            # Тот же запрос через PREPARE/EXECUTE; PREPARE - вне замеров
+            execute_sql, execute_params = prepare_query(pg_conn, query_name)
+            for i in range(warmup + iterations):
+                _, _, timings = time_pg_query(pg_conn, execute_sql, execute_params)
+                if i >= warmup:
+                    for metric, value in timings.items():
+                        samples[metric.replace("pg_", "pg_prepared_")].append(value)
+
+            key = f"bench:{query_name}"
+            redis_conn.set(key, encode_payload(rows, columns, codec))
+            for i in range(warmup + iterations):
+                timings = time_redis_read(redis_conn, key)
+                if i >= warmup:
+                    for metric, value in timings.items():
+                        samples[metric].append(value)
+            redis_conn.delete(key)
+
+            explains[query_name] = explain_query(pg_conn, query)
+            for metric, values in samples.items():
+                records.append({"query": query_name, "metric": metric, **summarize(values)})
+    finally:
+        release_pg(pg_conn)
+
+    regressions = compare_with_baseline(records, baseline, threshold) if baseline else []
+
+    print("\n=== Задержки, мс ===")
+    print(pd.DataFrame(records).to_string())
+
+    p50 = {(r["query"], r["metric"]): r["p50_ms"] for r in records}
+    print("\n=== Ad-hoc и подготовленные запросы, p50 мс ===")
+    print(pd.DataFrame([
+        {
+            "query": name,
+            "adhoc": p50[(name, "pg_total")],
+            "prepared": p50[(name, "pg_prepared_total")],
+            "speedup": p50[(name, "pg_total")] / p50[(name, "pg_prepared_total")]
+        }
+        for name in QUERIES
+        if (name, "pg_total") in p50 and p50.get((name, "pg_prepared_total"))
+    ]).to_string())
+    print("\n=== EXPLAIN (ANALYZE, BUFFERS) ===")
+    print(pd.DataFrame([
+        {"query": name, **{k: v for k, v in explain.items() if k != "plan"}}
+        for name, explain in explains.items()
+    ]).to_string())
+    print_acquire_metrics()
+
+    if output:
+        pd.DataFrame(records).to_csv(f"{output}.csv", index=False)
+        with open(f"{output}.json", "w", encoding="utf-8") as f:
+            json.dump({
+                "config": {"warmup": warmup, "iterations": iterations, "codec": codec,
+                           "cold_iterations": cold_iterations if cold_command else 0},
+                "records": records,
+                "explain": explains
+            }, f, cls=PGDataEncoder, ensure_ascii=False, indent=2)
+        print(f"\nРезультаты сохранены: {output}.json, {output}.csv")
+
+    for record in regressions:
+        print(f"РЕГРЕССИЯ: {record['query']} {record['metric']} p50 "
+              f"{record['baseline_p50_ms']:.3f} -> {record['p50_ms']:.3f} мс "
+              f"(+{record['change']:.0%})")
+    return regressions
+
+def load_worker(backend, redis_conn, stop_at, miss_ratio, latencies, errors):
+    """Клиент нагрузочного теста: запросы по кругу до stop_at"""
+    rng = random.Random()
+    names = list(QUERIES)
+
+    def read_postgres(query_name):
+        conn = acquire_pg()
+        try:
+            return execute_query(conn, QUERIES[query_name])
+        finally:
+            release_pg(conn)
+
+    while time.monotonic() < stop_at:
+        query_name = rng.choice(names)
+        start_time = time.perf_counter_ns()
+        try:
+            if backend == "postgres":
+                read_postgres(query_name)
+            else:
+                key = f"load:{query_name}"
+                payload = None if rng.random() < miss_ratio else redis_conn.get(key)
+                if payload is None:
+                    # Промах: чтение из PostgreSQL и перезапись кэша
+                    rows, columns, _ = read_postgres(query_name)
+                    redis_conn.setex(key, CACHE_TTL, encode_payload(rows, columns))
+                else:
+                    decode_payload(payload)
+            latencies.append(time.perf_counter_ns() - start_time)
+        except Exception:
+            errors.append(1)
+
+def run_load_level(backend, redis_conn, clients, duration, miss_ratio):
+    """clients потоков load_worker в течение duration; (задержки, ошибки, секунды)"""
+    latencies, errors = [], []
+    stop_at = time.monotonic() + duration
+    threads = [
+        threading.Thread(target=load_worker, args=(
+            backend, redis_conn, stop_at, miss_ratio, latencies, errors
+        ))
+        for _ in range(clients)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors, time.perf_counter() - started
+
+def warm_pools(backend, redis_conn, clients, miss_ratio, warmup=LOAD_WARMUP):
+    """Открытие clients соединений PostgreSQL и прогрев вне замера.
+
+    Новое соединение - это подключение с SCRAM-аутентификацией и проверкой
+    SELECT 1; без прогрева эти затраты попадали бы в p95/p99 каждого
+    следующего уровня параллелизма.
+    """
+    conns = [acquire_pg() for _ in range(clients)]
+    for conn in conns:
+        release_pg(conn)
+    if warmup:
+        run_load_level(backend, redis_conn, clients, warmup, miss_ratio)
+
+def run_load_test(concurrency=LOAD_CONCURRENCY, duration=LOAD_DURATION,
+                  miss_ratio=LOAD_MISS_RATIO, warmup=LOAD_WARMUP):
+    """Нагрузочный режим: QPS и перцентили PostgreSQL и кэша на каждом уровне параллелизма"""
+    max_clients = max(concurrency)
+    configure_pools(pg_max=max_clients, redis_max=max_clients)
+    redis_conn = get_redis()
+
+    results = []
+    for backend in ("postgres", "cache"):
+        for clients in concurrency:
+            warm_pools(backend, redis_conn, clients, miss_ratio, warmup)
+            latencies, errors, elapsed = run_load_level(backend, redis_conn, clients,
+                                                        duration, miss_ratio)
+
+            result = {"backend": backend, "clients": clients,
+                      "qps": len(latencies) / elapsed, "errors": len(errors)}
+            if latencies:
+                result.update(summarize(latencies))
+            results.append(result)
+            print(f"{backend} x{clients}: {result['qps']:.0f} запросов/сек")
+
+    print("\n=== Нагрузочный тест ===")
+    print(pd.DataFrame(results).to_string())
+    print_acquire_metrics()
+    return results
 
 if __name__ == "__main__":
-    run_performance_test()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Сравнение PostgreSQL и кэша в Redis")
+    parser.add_argument("--quick", action="store_true",
+                        help="прежний однократный прогон и сравнение кодеков")
+    parser.add_argument("--load", action="store_true",
+                        help="нагрузочный режим с несколькими клиентами")
+    parser.add_argument("--concurrency", default=",".join(map(str, LOAD_CONCURRENCY)),
+                        help="уровни параллелизма через запятую")
+    parser.add_argument("--duration", type=float, default=LOAD_DURATION,
+                        help="сек на каждый уровень параллелизма")
+    parser.add_argument("--miss-ratio", type=float, default=LOAD_MISS_RATIO,
+                        help="доля промахов кэша")
+    parser.add_argument("--load-warmup", type=float, default=LOAD_WARMUP,
+                        help="сек прогрева вне замера перед каждым уровнем параллелизма")
+    parser.add_argument("--warmup", type=int, default=WARMUP)
+    parser.add_argument("--iterations", type=int, default=ITERATIONS)
+    parser.add_argument("--codec", choices=sorted(CODECS), default=DEFAULT_CODEC)
+    parser.add_argument("--cold-command",
+                        help="команда сброса кэшей БД и ОС перед холодным замером")
+    parser.add_argument("--cold-iterations", type=int, default=3)
+    parser.add_argument("--output", help="префикс файлов .json и .csv с результатами")
+    parser.add_argument("--baseline", help="JSON предыдущего прогона для сравнения")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="допустимый рост p50 (доля)")
+    args = parser.parse_args()
+
+    if args.quick:
+        run_performance_test()
+        run_codec_report()
+    elif args.load:
+        run_load_test(concurrency=[int(n) for n in args.concurrency.split(",")],
+                      duration=args.duration, miss_ratio=args.miss_ratio,
+                      warmup=args.load_warmup)
+    else:
+        regressions = run_benchmark(
+            warmup=args.warmup, iterations=args.iterations, codec=args.codec,
+            cold_command=args.cold_command, cold_iterations=args.cold_iterations,
+            output=args.output, baseline=args.baseline, threshold=args.threshold
+        )
+        if regressions:
+            sys.exit(1)
\ No newline at end of file